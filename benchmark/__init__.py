@@ -0,0 +1,10 @@
+"""
+Benchmarks of emspy on synthetic UEMS output; no UEMS required.
+
+synthetic writes WRF-like wrfout files and chunk directory trees;
+harness times extraction and chunk orchestration, checks that chunks
+shared amongst workers (-w) are all run even should one die and that prep
+finds the input data the cache (--cache) links in, and reports JSON, e.g.
+
+    python -m benchmark.harness -o before.json
+"""
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time emspy on a synthetic chunked simulation and report JSON, so that
+versions can be compared on a machine without UEMS.
+"""
+
+import os
+import sys
+import glob
+import time
+import json
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import itertools
+import subprocess
+import numpy as np
+import netCDF4
+
+from benchmark import synthetic
+
+
+# Where the scripts being timed live
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stand-ins for the UEMS scripts ems_chunk.py calls; prep and run leave
+# behind what the real ones would, after sleeping STUB_PREP or STUB_RUN.
+# Prep also notes the input data it found in grib, which UEMS would use
+# rather than download, and run leaves a copy of STUB_WRFOUT (if given)
+STUBS = {
+    'ems_clean': '#!/bin/sh\n',
+    'ems_domain.pl': '#!/bin/sh\n',
+    'ems_prep.pl': '#!/bin/sh\nsleep ${STUB_PREP:-0}\n'
+                   'mkdir -p wpsprd && touch wpsprd/met_em.d01.nc\n'
+                   'ls grib > wpsprd/grib.txt 2> /dev/null || true\n',
+    'ems_run.pl': '#!/bin/sh\nsleep ${STUB_RUN:-0}\nmkdir -p wrfprd\n'
+                  'if [ -n "$STUB_WRFOUT" ]; then cp "$STUB_WRFOUT" wrfprd/; '
+                  'else touch wrfprd/wrfout_d01_stub; fi\n',
+}
+
+# Local name UEMS gives CFSR files in a run's grib directory (LOCFIL of its
+# gribinfo file), and the same as per strftime
+LOCFIL = 'YYMMDDCC.cfsrpt.tCCz.pgrbhFF.grb2'
+LOCFIL_STRFTIME = '%y%m%d%H.cfsrpt.t%Hz.pgrbh00.grb2'
+
+# Configuration files ems_chunk.py modifies
+CONFS = {
+    'wrfout': 'HISTORY_INTERVAL = 180\nFRAMES_PER_OUTFILE = 1\n',
+    'levels': 'LEVELS = 45\nPTOP = 5000\n',
+    'physics': 'CU_PHYSICS = 1\nMP_PHYSICS = 2\nSF_SFCLAY_PHYSICS = 2\n',
+}
+
+
+def timeit(f, repeat=3):
+    """
+    Call f repeat times, returning the best wall time (s) and last result.
+    """
+
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        result = f()
+        t = time.time()-t0
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+def version():
+    """
+    Return git description of the scripts being timed, if available.
+    """
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=ROOT, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sites(w, n, seed=0):
+    """
+    Return latitudes, longitudes of n random sites within the grid of w.
+    """
+
+    rs = np.random.RandomState(seed)
+    i = rs.randint(1, w.ni-1, n)
+    j = rs.randint(1, w.nj-1, n)
+    return w.xlat[i, j].astype(float), w.xlon[i, j].astype(float)
+
+
+def bench_dataset(wrfFile, nSites, repeat):
+    """
+    Time opening a wrfout file (with and without the geometry cache),
+    locating sites, and extracting fields and points.
+    """
+
+    from ems_dechunk import WRFDataset
+
+    results = {}
+    cache = os.path.join(os.path.dirname(wrfFile), 'geometry.npz')
+
+    t, _ = timeit(lambda: WRFDataset(wrfFile).f.close(), repeat)
+    results['open'] = {'seconds': t}
+
+    WRFDataset(wrfFile, cache=cache).f.close()
+    t, _ = timeit(lambda: WRFDataset(wrfFile, cache=cache).f.close(), repeat)
+    results['open_cached'] = {'seconds': t}
+
+    w = WRFDataset(wrfFile, cache=cache)
+    lat, lon = sites(w, nSites)
+
+    t, _ = timeit(lambda: w.ll2ij(lat, lon), repeat)
+    results['ll2ij'] = {'seconds': t, 'sites': nSites, 'sites_per_second': nSites/t}
+
+    i, j = w.ll2ij(lat, lon)
+
+    # Fresh reads each time; no help from the read cache
+    def extract(f):
+        w.cache.clear()
+        w.cached = 0
+        return f()
+
+    for name, f in [('extract', lambda: w.extract('T2')),
+                    ('extract_points', lambda: w.extract_points('T2', i, j)),
+                    ('extract_heights', lambda: w.extract_heights('U', [80.0, 100.0, 120.0], i, j))]:
+        t, a = timeit(lambda: extract(f), repeat)
+        results[name] = {'seconds': t, 'MB': a.nbytes/1e6, 'MB_per_second': a.nbytes/1e6/t}
+
+    w.f.close()
+
+    return results
+
+
+def bench_dechunk(emsRun, domain, nSites, hours, repeat, workers):
+    """
+    Time de-chunking sites from all chunks end-to-end with ems_dechunk.py.
+    """
+
+    from ems_dechunk import WRFDataset
+
+    wrfFiles = sorted(glob.glob(os.path.join(emsRun, '%s_*' % domain, 'wrfprd', 'wrfout_d01_*')))
+    size = sum(os.path.getsize(_) for _ in wrfFiles)
+
+    with WRFDataset(wrfFiles[0]) as w:
+        lat, lon = sites(w, nSites)
+
+    sitesFile = os.path.join(emsRun, 'sites.csv')
+    with open(sitesFile, 'w') as f:
+        f.write('name,lat,lon\n')
+        for s in range(nSites):
+            f.write('site%05d,%.5f,%.5f\n' % (s, lat[s], lon[s]))
+
+    env = dict(os.environ, EMS_RUN=emsRun)
+
+    results = {}
+    for fmt in ['csv', 'npz']:
+        for n in sorted(set([1, workers])):
+
+            cmd = [sys.executable, os.path.join(ROOT, 'ems_dechunk.py'), domain,
+                   '-s', sitesFile, '-f', fmt, '-w', str(n)]
+            run = lambda: subprocess.check_call(cmd, cwd=emsRun, env=env,
+                                                stdout=open(os.devnull, 'w'))
+
+            t, _ = timeit(run, repeat)
+            results['dechunk_%s_w%d' % (fmt, n)] = {
+                'seconds': t, 'sites': nSites, 'hours': hours, 'chunks': len(wrfFiles),
+                'site_hours_per_second': nSites*hours/t, 'MB_per_second': size/1e6/t}
+
+    return results
+
+
+def stub(emsRun, domain, staticMB, prep, run):
+    """
+    Set up stub UEMS scripts (once) and master domain in emsRun, returning
+    the environment to run ems_chunk.py in with prep and run taking prep
+    and run seconds.
+    """
+
+    # Stub UEMS, and its configuration
+    binDir = os.path.join(emsRun, 'bin')
+    confDir = os.path.join(emsRun, 'conf')
+    if not os.path.isdir(binDir):
+        os.makedirs(binDir)
+        for name, script in STUBS.items():
+            with open(os.path.join(binDir, name), 'w') as f:
+                f.write(script)
+            os.chmod(os.path.join(binDir, name), 0755)
+        os.makedirs(os.path.join(confDir, 'gribinfo'))
+        with open(os.path.join(confDir, 'gribinfo', 'cfsrpt_gribinfo.conf'), 'w') as f:
+            f.write('LOCFIL = %s\n' % LOCFIL)
+
+    # Master domain
+    domainDir = os.path.join(emsRun, domain)
+    for d in ['conf/ems_run', 'static', 'wpsprd', 'wrfprd']:
+        os.makedirs(os.path.join(domainDir, d))
+    for conf, text in CONFS.items():
+        with open(os.path.join(domainDir, 'conf', 'ems_run', 'run_%s.conf' % conf), 'w') as f:
+            f.write(text)
+    with open(os.path.join(domainDir, 'static', 'geo_em.d01.nc'), 'wb') as f:
+        f.write(os.urandom(staticMB*1024**2))
+
+    return dict(os.environ, EMS_RUN=emsRun, EMS_CONF=confDir,
+                PATH=binDir + os.pathsep + os.environ['PATH'],
+                STUB_PREP=str(prep), STUB_RUN=str(run))
+
+
+def bench_chunk(emsRun, days, repeat, staticMB, prep, run):
+    """
+    Time ems_chunk.py orchestration (cloning, prepping and running) of a
+    domain using stub UEMS scripts that take prep and run seconds.
+    """
+
+    domain = 'stub'
+    env = stub(emsRun, domain, staticMB, prep, run)
+
+    startDate = datetime.datetime(2000, 1, 1)
+    endDate = startDate + datetime.timedelta(days=days)
+
+    results = {}
+    for name, options in [('chunk', []),
+                          ('chunk_hardlink', ['-l', 'hard']),
+                          ('chunk_concurrent', ['-c', '2', '--nodes', '2']),
+                          ('chunk_prepahead', ['-p', '2', '--nodes', '2'])]:
+
+        cmd = [sys.executable, os.path.join(ROOT, 'ems_chunk.py'), domain,
+               startDate.strftime('%Y%m%d'), endDate.strftime('%Y%m%d')] + options
+
+        def chunk():
+            for runDir in glob.glob(os.path.join(emsRun, '%s_*' % domain)):
+                shutil.rmtree(runDir)
+            subprocess.check_call(cmd, cwd=emsRun, env=env, stdout=open(os.devnull, 'w'))
+            return len(glob.glob(os.path.join(emsRun, '%s_*' % domain)))
+
+        t, chunks = timeit(chunk, repeat)
+        results[name] = {'seconds': t, 'chunks': chunks, 'chunks_per_second': chunks/t,
+                         'prep_seconds': prep, 'run_seconds': run}
+
+    return results
+
+
+def bench_workers(emsRun, days, staticMB, workers=3, run=2.0, lease=5):
+    """
+    Run ems_chunk.py as several workers (-w) sharing the chunks of a domain
+    using stub UEMS scripts, killing one as soon as it has claimed a chunk,
+    and check that every chunk is run; the dead worker's once its lease
+    lapses.
+    """
+
+    from ems_chunk import ChunkState, ems_plan, state_files
+
+    domain = 'stubw'
+    env = stub(emsRun, domain, staticMB, 0, run)
+
+    startDate = datetime.datetime(2000, 1, 1)
+    endDate = startDate + datetime.timedelta(days=days)
+
+    cmd = [sys.executable, os.path.join(ROOT, 'ems_chunk.py'), domain,
+           startDate.strftime('%Y%m%d'), endDate.strftime('%Y%m%d'),
+           '-w', '--lease', str(lease)]
+
+    t0 = time.time()
+    procs = dict((p.pid, p) for p in [
+        subprocess.Popen(cmd, cwd=emsRun, env=env, stdout=open(os.devnull, 'w'),
+                         stderr=open(os.devnull, 'w')) for _ in range(workers)])
+
+    # As if its host went down; its claim is left behind
+    queueDir = os.path.join(emsRun, '%s.queue' % domain)
+    killed = None
+    while killed is None and all(p.poll() is None for p in procs.values()):
+        for lock in glob.glob(os.path.join(queueDir, '%s_*.lock' % domain)):
+            try:
+                with open(lock) as f:
+                    pid = int(json.load(f)['worker'].rsplit('.', 1)[1])
+            except (IOError, ValueError, KeyError):
+                # Just released, or not yet written
+                continue
+            if pid in procs:
+                killed = procs.pop(pid)
+                killed.kill()
+                killed.wait()
+                break
+        time.sleep(0.05)
+
+    # The rest keep at it until every chunk is done
+    deadline = time.time() + 60 + 4*lease
+    while any(p.poll() is None for p in procs.values()):
+        if time.time() > deadline:
+            for p in procs.values():
+                p.kill()
+            print 'ERROR:  Workers of %s still going after %d s' % (domain, time.time()-t0)
+            raise SystemExit
+        time.sleep(0.1)
+    t = time.time()-t0
+
+    chunks = [os.path.join(emsRun, '%s_%s' % (domain, _['startDate'].strftime('%Y%m%d')))
+              for _ in ems_plan(startDate, endDate)]
+    ran = set()
+    for fileName in state_files(os.path.join(emsRun, domain)):
+        with ChunkState(fileName) as state:
+            ran.update(_ for _ in chunks if state.done(_, 'run'))
+    done = [_ for _ in chunks if _ in ran and
+            os.path.exists(os.path.join(queueDir, '%s.run' % os.path.basename(_)))]
+    with open(os.path.join(emsRun, '%s.log' % domain)) as f:
+        reclaimed = sum('Reclaiming' in _ for _ in f)
+
+    if killed is None or len(done) < len(chunks) or not reclaimed:
+        print 'ERROR:  %d of %d chunks of %s run by %d workers, %d reclaimed from a killed worker' % (
+            len(done), len(chunks), domain, workers, reclaimed)
+        raise SystemExit
+
+    return {'chunk_workers': {'seconds': t, 'chunks': len(chunks), 'run': len(done),
+                              'workers': workers, 'killed': 1, 'reclaimed': reclaimed,
+                              'lease_seconds': lease, 'run_seconds': run}}
+
+
+def bench_cache(emsRun, days, staticMB, prep, run):
+    """
+    Run ems_chunk.py with an input data cache filled from a local source
+    directory using stub UEMS scripts, and check that every input needed is
+    fetched once and that each chunk's prep found all of its own in its grib
+    directory, under the names UEMS looks for.
+    """
+
+    from ems_cache import dset_times
+    from ems_chunk import ems_plan
+
+    domain = 'stubc'
+    env = stub(emsRun, domain, staticMB, prep, run)
+
+    startDate = datetime.datetime(2000, 1, 1)
+    endDate = startDate + datetime.timedelta(days=days)
+    chunks = ems_plan(startDate, endDate)
+
+    # Every analysis needed, each different
+    sourceDir = os.path.join(emsRun, 'source')
+    os.makedirs(sourceDir)
+    times = sorted(set(itertools.chain(*[
+        dset_times('cfsrpt', _['spinupDate'], _['hours']) for _ in chunks])))
+    for valid in times:
+        with open(os.path.join(sourceDir, valid.strftime('%Y%m%d%H.grb2')), 'wb') as f:
+            f.write(os.urandom(1024))
+
+    cmd = [sys.executable, os.path.join(ROOT, 'ems_chunk.py'), domain,
+           startDate.strftime('%Y%m%d'), endDate.strftime('%Y%m%d'), '-d', 'cfsrpt',
+           '--cache', os.path.join(emsRun, 'cache'),
+           '--source', os.path.join(sourceDir, '%Y%m%d%H.grb2')]
+
+    t0 = time.time()
+    subprocess.check_call(cmd, cwd=emsRun, env=env, stdout=open(os.devnull, 'w'))
+    t = time.time()-t0
+
+    with open(os.path.join(emsRun, '%s.log' % domain)) as f:
+        fetched = sum('Fetching' in _ for _ in f)
+
+    found = 0
+    for chunk in chunks:
+        runDir = os.path.join(emsRun, '%s_%s' % (domain, chunk['startDate'].strftime('%Y%m%d')))
+        with open(os.path.join(runDir, 'wpsprd', 'grib.txt')) as f:
+            names = set(f.read().split())
+        if names == set(_.strftime(LOCFIL_STRFTIME) for _ in
+                        dset_times('cfsrpt', chunk['spinupDate'], chunk['hours'])):
+            found += 1
+
+    if fetched != len(times) or found < len(chunks):
+        print 'ERROR:  %d of %d times of %s fetched; %d of %d chunks prepped with all of theirs' % (
+            fetched, len(times), domain, found, len(chunks))
+        raise SystemExit
+
+    return {'chunk_cache': {'seconds': t, 'chunks': len(chunks), 'times': len(times),
+                            'fetched': fetched, 'prepped_from_cache': found,
+                            'prep_seconds': prep, 'run_seconds': run}}
+
+
+def bench_slim(emsRun, days, staticMB, wrfFile, concurrent=2):
+    """
+    Run ems_chunk.py with --slim on concurrent chunks at a time using stub
+    UEMS scripts whose run leaves a copy of (synthetic) wrfFile, and check
+    that every chunk is slimmed, and its slim file holds what the full
+    one does.
+    """
+
+    from ems_dechunk import slim_file
+
+    domain = 'stubs'
+    env = dict(stub(emsRun, domain, staticMB, 0, 0), STUB_WRFOUT=wrfFile)
+
+    startDate = datetime.datetime(2000, 1, 1)
+    endDate = startDate + datetime.timedelta(days=days)
+
+    cmd = [sys.executable, os.path.join(ROOT, 'ems_chunk.py'), domain,
+           startDate.strftime('%Y%m%d'), endDate.strftime('%Y%m%d'), '--slim',
+           '-c', str(concurrent), '--nodes', str(concurrent)]
+
+    t0 = time.time()
+    out = subprocess.check_output(cmd, cwd=emsRun, env=env)
+    t = time.time()-t0
+
+    runDirs = sorted(glob.glob(os.path.join(emsRun, '%s_*' % domain)))
+    slimmed = 0
+    for runDir in runDirs:
+        fullName = os.path.join(runDir, 'wrfprd', os.path.basename(wrfFile))
+        if not os.path.isfile(slim_file(fullName)):
+            continue
+        with netCDF4.Dataset(fullName) as full, netCDF4.Dataset(slim_file(fullName)) as slim:
+            if all(np.array_equal(full.variables[_][:], slim.variables[_][:]) for _ in slim.variables):
+                slimmed += 1
+
+    if 'FAILED' in out or not runDirs or slimmed < len(runDirs):
+        print 'ERROR:  %d of %d chunks of %s slimmed, %d at a time' % (
+            slimmed, len(runDirs), domain, concurrent)
+        raise SystemExit
+
+    return {'chunk_slim': {'seconds': t, 'chunks': len(runDirs), 'slimmed': slimmed,
+                           'concurrent': concurrent, 'MB': os.path.getsize(wrfFile)/1e6}}
+
+
+def main():
+    """
+    Benchmark emspy on a synthetic chunked simulation.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('-o', '--output', metavar='json',
+        help='specify file to write results to; otherwise printed')
+
+    parser.add_argument('-c', '--chunks', metavar='int', default=4, type=int,
+        help='specify number of (3 day) chunks of synthetic simulation')
+
+    parser.add_argument('--shape', metavar=('ni', 'nj', 'nk'), nargs=3, default=[60, 70, 10],
+        type=int, help='specify grid shape of synthetic simulation')
+
+    parser.add_argument('-s', '--sites', metavar='int', default=1000, type=int,
+        help='specify number of sites to extract')
+
+    parser.add_argument('-w', '--workers', metavar='int', default=4, type=int,
+        help='specify number of worker processes to de-chunk with (as well as one)')
+
+    parser.add_argument('-r', '--repeat', metavar='int', default=3, type=int,
+        help='specify number of times to repeat each timing; best is kept')
+
+    parser.add_argument('--static', metavar='MB', default=64, type=int,
+        help='specify size of static files cloned by ems_chunk')
+
+    parser.add_argument('--stub', metavar=('prep', 'run'), nargs=2, default=[0.0, 0.0],
+        type=float, help='specify seconds stub ems_prep.pl and ems_run.pl take')
+
+    parser.add_argument('--dir', metavar='path',
+        help='specify directory to work in; a temporary one is used (and removed) otherwise')
+
+    args = parser.parse_args()
+
+    emsRun = args.dir or tempfile.mkdtemp(prefix='emspy_benchmark_')
+    if not os.path.isdir(emsRun):
+        os.makedirs(emsRun)
+
+    # Scripts read EMS_RUN when imported
+    os.environ['EMS_RUN'] = emsRun
+    sys.path.insert(0, ROOT)
+
+    ni, nj, nk = args.shape
+    chunkDays = 3
+
+    report = {
+        'version': version(),
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                    'cpus': os.sysconf('SC_NPROCESSORS_ONLN')},
+        'software': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'netCDF4': netCDF4.__version__, 'netcdf': netCDF4.__netcdf4libversion__,
+                     'hdf5': netCDF4.__hdf5libversion__},
+        'parameters': {'chunks': args.chunks, 'shape': args.shape, 'sites': args.sites,
+                       'workers': args.workers, 'repeat': args.repeat,
+                       'static_MB': args.static, 'stub': args.stub},
+        'results': {},
+    }
+
+    try:
+
+        print 'Writing synthetic simulation to', emsRun
+        t0 = time.time()
+        runDirs = synthetic.tree(emsRun, 'synth', datetime.datetime(2000, 1, 1), args.chunks,
+                                 chunkDays=chunkDays, ni=ni, nj=nj, nk=nk)
+        report['results']['synthetic'] = {'seconds': time.time()-t0}
+
+        print 'Timing WRFDataset'
+        wrfFile = glob.glob(os.path.join(runDirs[0], 'wrfprd', 'wrfout_d01_*'))[0]
+        report['results'].update(bench_dataset(wrfFile, args.sites, args.repeat))
+
+        print 'Timing ems_dechunk.py'
+        report['results'].update(bench_dechunk(emsRun, 'synth', args.sites, args.chunks*chunkDays*24,
+                                               args.repeat, args.workers))
+
+        print 'Timing ems_chunk.py'
+        report['results'].update(bench_chunk(emsRun, args.chunks*chunkDays, args.repeat,
+                                             args.static, *args.stub))
+
+        print 'Checking ems_chunk.py workers'
+        report['results'].update(bench_workers(emsRun, args.chunks*chunkDays, args.static))
+
+        print 'Checking ems_chunk.py slimming concurrent chunks'
+        report['results'].update(bench_slim(emsRun, args.chunks*chunkDays, args.static, wrfFile))
+
+        print 'Checking ems_chunk.py input data cache'
+        report['results'].update(bench_cache(emsRun, args.chunks*chunkDays, args.static,
+                                             *args.stub))
+
+    finally:
+        if not args.dir:
+            shutil.rmtree(emsRun)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print 'Wrote to', args.output
+    else:
+        print json.dumps(report, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
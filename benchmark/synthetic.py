@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Write synthetic WRF output (wrfout_dNN files) and UEMS chunk directory trees
+of realistic shape for benchmarking, on a Lambert Conformal grid.
+"""
+
+import os
+import argparse
+import datetime
+import numpy as np
+from netCDF4 import Dataset
+
+
+# WRF mean radius of earth (m)
+RE = 6370000.0
+
+
+def lambert(ni, nj, dx, cenLat, cenLon, truelat1, truelat2, standLon):
+    """
+    Return latitudes and longitudes (ni by nj) of a Lambert Conformal grid
+    centred on cenLat, cenLon with spacing dx (m).
+    """
+
+    if truelat1 == truelat2:
+        cone = np.sin(np.radians(abs(truelat1)))
+    else:
+        cone = (np.log(np.cos(np.radians(truelat1))) - np.log(np.cos(np.radians(truelat2)))) / \
+            (np.log(np.tan(np.radians(90.0-abs(truelat1))*0.5)) -
+             np.log(np.tan(np.radians(90.0-abs(truelat2))*0.5)))
+
+    # Radius (in grid cells) to centre, and pole point
+    k = RE/dx*np.cos(np.radians(truelat1))/cone
+    t1 = np.tan(np.radians(90.0-truelat1)*0.5)
+    rc = k*(np.tan(np.radians(90.0-cenLat)*0.5)/t1)**cone
+    dlon = cenLon-standLon
+    polex = (nj+1)/2.0 - rc*np.sin(cone*np.radians(dlon))
+    poley = (ni+1)/2.0 + rc*np.cos(cone*np.radians(dlon))
+
+    y, x = np.mgrid[1:ni+1, 1:nj+1].astype(float)
+    r = np.hypot(x-polex, y-poley)
+    lat = 90.0-2*np.degrees(np.arctan(t1*(r/k)**(1.0/cone)))
+    lon = np.degrees(np.arctan2(x-polex, poley-y))/cone + standLon
+
+    return lat, ((lon+180.0) % 360)-180.0
+
+
+def wrfout(fileName, startDate, hours, ni=60, nj=70, nk=10, dx=12000.0,
+           cenLat=33.8, cenLon=-84.3, seed=0):
+    """
+    Write a synthetic hourly wrfout file of hours (plus the initial hour)
+    starting at startDate, with compressed, chunked surface and 3D
+    (staggered) fields.
+    """
+
+    rs = np.random.RandomState(seed)
+    lat, lon = lambert(ni, nj, dx, cenLat, cenLon, 30.0, 60.0, cenLon)
+    nt = hours+1
+
+    f = Dataset(fileName, 'w', format='NETCDF4')
+
+    for d, n in [('Time', None), ('south_north', ni), ('west_east', nj),
+                 ('south_north_stag', ni+1), ('west_east_stag', nj+1),
+                 ('bottom_top', nk), ('bottom_top_stag', nk+1)]:
+        f.createDimension(d, n)
+
+    f.TITLE = ' OUTPUT FROM WRF V3.7.1 MODEL'
+    f.START_DATE = startDate.strftime('%Y-%m-%d_%H:%M:%S')
+    f.MAP_PROJ = np.int32(1)
+    f.TRUELAT1 = np.float32(30.0)
+    f.TRUELAT2 = np.float32(60.0)
+    f.STAND_LON = np.float32(cenLon)
+    f.CEN_LAT = np.float32(cenLat)
+    f.CEN_LON = np.float32(cenLon)
+    f.DX = np.float32(dx)
+    f.DY = np.float32(dx)
+
+    def variable(n, dims, data, units, desc):
+        chunks = [1]*(len(dims)-2) + [f.dimensions[_].size for _ in dims[-2:]]
+        v = f.createVariable(n, 'f4', dims, zlib=True, complevel=2,
+                             chunksizes=chunks if len(dims) > 1 else None)
+        v.units = units
+        v.description = desc
+        v[:] = data
+
+    # Smooth in space and time, with a little noise
+    hour = np.arange(nt)
+    diurnal = np.sin(2*np.pi*(hour+startDate.hour)/24.0)[:, None, None]
+    smooth = np.cos(np.radians(lat))[None]
+    noise = lambda *shape: rs.standard_normal(shape).astype(np.float32)
+    S = ('Time', 'south_north', 'west_east')
+
+    variable('XTIME', ('Time',), hour*60.0, 'minutes since %s' % f.START_DATE, 'minutes since simulation start')
+    variable('XLAT', S, np.repeat(lat[None], nt, 0), 'degree_north', 'LATITUDE, SOUTH IS NEGATIVE')
+    variable('XLONG', S, np.repeat(lon[None], nt, 0), 'degree_east', 'LONGITUDE, WEST IS NEGATIVE')
+    hgt = 200+300*smooth[0]**4
+    variable('HGT', S, np.repeat(hgt[None], nt, 0), 'm', 'Terrain Height')
+    variable('T2', S, 280+10*smooth+5*diurnal+0.5*noise(nt, ni, nj), 'K', 'TEMP at 2 M')
+    variable('TSK', S, 281+10*smooth+8*diurnal+0.5*noise(nt, ni, nj), 'K', 'SURFACE SKIN TEMPERATURE')
+    variable('Q2', S, 0.008+0.002*smooth+0.0002*noise(nt, ni, nj), 'kg kg-1', 'QV at 2 M')
+    variable('RH02', S, np.clip(0.7-0.2*diurnal+0.05*noise(nt, ni, nj), 0, 1), 'fraction', 'RH at 2 M')
+    variable('PSFC', S, 101325-12*hgt+50*noise(nt, ni, nj), 'Pa', 'SFC PRESSURE')
+    variable('U10', S, 3+2*diurnal+noise(nt, ni, nj), 'm s-1', 'U at 10 M')
+    variable('V10', S, 1-diurnal+noise(nt, ni, nj), 'm s-1', 'V at 10 M')
+    variable('SWDOWN', S, np.clip(900*diurnal*smooth, 0, None), 'W m-2', 'DOWNWARD SHORT WAVE FLUX AT GROUND SURFACE')
+    variable('TACC_PRECIP', S, np.cumsum(np.clip(noise(nt, ni, nj)-1, 0, None), 0), 'mm', 'ACCUMULATED TOTAL GRID SCALE PRECIPITATION')
+    variable('TACC_SNOW', S, np.cumsum(np.clip(noise(nt, ni, nj)-2, 0, None), 0), 'mm', 'ACCUMULATED SNOW')
+
+    # Winds increasing with height; levels stretched towards the top
+    z = 20000*np.linspace(0, 1, nk+1)**1.5
+    wind = np.log1p(z[:-1]/10.0)[None, :, None, None]
+    variable('U', ('Time', 'bottom_top', 'south_north', 'west_east_stag'),
+             2*wind+noise(nt, nk, ni, nj+1), 'm s-1', 'x-wind component')
+    variable('V', ('Time', 'bottom_top', 'south_north_stag', 'west_east'),
+             wind+noise(nt, nk, ni+1, nj), 'm s-1', 'y-wind component')
+    variable('W', ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+             0.1*noise(nt, nk+1, ni, nj), 'm s-1', 'z-wind component')
+    phb = 9.81*(hgt[None, None]+z[None, :, None, None])*np.ones((nt, 1, 1, 1))
+    variable('PHB', ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+             phb, 'm2 s-2', 'base-state geopotential')
+    variable('PH', ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+             10*noise(nt, nk+1, ni, nj), 'm2 s-2', 'perturbation geopotential')
+
+    f.close()
+
+
+def tree(emsRun, domain, startDate, chunks, chunkDays=3, spinupHours=12,
+         nDomains=1, **kwargs):
+    """
+    Write a master domain (static files only) and chunks run directories of
+    domain in emsRun, as ems_chunk.py would leave them, each with a wrfout
+    file per domain.  Remaining arguments are passed to wrfout.
+    Returns the run directories.
+    """
+
+    static = os.path.join(emsRun, domain, 'static')
+    if not os.path.isdir(static):
+        os.makedirs(static)
+    for d in range(1, nDomains+1):
+        open(os.path.join(static, 'geo_em.d%02d.nc' % d), 'w').close()
+
+    runDirs = []
+    for c in range(chunks):
+
+        chunkDate = startDate + datetime.timedelta(days=c*chunkDays)
+        spinupDate = chunkDate - datetime.timedelta(hours=spinupHours)
+
+        runDir = os.path.join(emsRun, '%s_%s' % (domain, chunkDate.strftime('%Y%m%d')))
+        wrfprd = os.path.join(runDir, 'wrfprd')
+        if not os.path.isdir(wrfprd):
+            os.makedirs(wrfprd)
+
+        for d in range(1, nDomains+1):
+            wrfout(os.path.join(wrfprd, 'wrfout_d%02d_%s' % (d, spinupDate.strftime('%Y-%m-%d_%H:%M:%S'))),
+                   spinupDate, chunkDays*24+spinupHours, seed=c, **kwargs)
+
+        runDirs.append(runDir)
+
+    return runDirs
+
+
+def main():
+    """
+    Write a synthetic chunked simulation of domain in emsRun.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('emsRun', help='specify directory to write to (i.e. EMS_RUN)')
+
+    parser.add_argument('domain', help='specify root domain')
+
+    parser.add_argument('-s', '--start', default='20000101',
+        help='specify start date YYYYMMDD')
+
+    parser.add_argument('-c', '--chunks', metavar='int', default=4, type=int,
+        help='specify number of chunks')
+
+    parser.add_argument('--shape', metavar=('ni', 'nj', 'nk'), nargs=3, default=[60, 70, 10],
+        type=int, help='specify grid shape')
+
+    parser.add_argument('-n', '--nest', metavar='int', default=1, type=int,
+        help='specify number of domains')
+
+    args = parser.parse_args()
+
+    ni, nj, nk = args.shape
+    for runDir in tree(args.emsRun, args.domain, datetime.datetime.strptime(args.start, '%Y%m%d'),
+                       args.chunks, nDomains=args.nest, ni=ni, nj=nj, nk=nk):
+        print 'Wrote', runDir
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+import datetime
+import errno
+import hashlib
+import logging
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib2
+import multiprocessing.pool
+
+
+# Hours between analyses of each dataset
+DSET_HOURS = {'cfsrpt': 6, 'narrpt': 3}
+
+# Size (GB) the cache is kept under
+CACHE_SIZE = 100
+
+
+class InputCache(object):
+    """
+    Local cache of input (e.g. CFSR, NARR) files ems_prep needs, keyed by
+    dataset and valid time.  Files are stored once by content (SHA-1), so
+    the same file under different keys is only kept once, and are handed
+    out as hard links.  Once over size, the least recently used are evicted.
+    Safe to share amongst threads.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            dset TEXT, valid TEXT, name TEXT, sha1 TEXT, size INTEGER, used REAL,
+            PRIMARY KEY (dset, valid));
+    """
+
+    def __init__(self, path, size=CACHE_SIZE*1024**3):
+        """
+        Open (creating if need be) cache in directory path, kept under size
+        bytes.
+        """
+
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+
+        try:
+            os.makedirs(os.path.join(path, 'objects'))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'), timeout=60,
+                                  check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def object(self, sha1):
+        return os.path.join(self.path, 'objects', sha1[:2], sha1)
+
+    def get(self, dset, valid):
+        """
+        Return file name and cached path of dset at valid (a datetime), or
+        None if not cached.
+        """
+
+        with self.lock, self.db:
+            row = self.db.execute('SELECT name, sha1 FROM files WHERE dset=? AND valid=?',
+                                  (dset, valid.isoformat())).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE files SET used=? WHERE dset=? AND valid=?',
+                            (time.time(), dset, valid.isoformat()))
+
+        name, sha1 = row
+        if not os.path.isfile(self.object(sha1)):
+            logging.warning('%s missing from cache' % self.object(sha1))
+            return None
+        return name, self.object(sha1)
+
+    def put(self, dset, valid, name, fileName):
+        """
+        Move fileName into the cache as dset at valid, to be handed out as
+        name.  Returns its cached path.
+        """
+
+        h = hashlib.sha1()
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), ''):
+                h.update(block)
+        sha1 = h.hexdigest()
+        size = os.path.getsize(fileName)
+
+        path = self.object(sha1)
+        with self.lock:
+            if os.path.isfile(path):
+                os.remove(fileName)
+            else:
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                # Read-only, as handed out as hard links
+                os.chmod(fileName, 0444)
+                os.rename(fileName, path)
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                (dset, valid.isoformat(), name, sha1, size, time.time()))
+
+        return path
+
+    def fetch(self, dset, valid, source):
+        """
+        Return file name and cached path of dset at valid, first fetching it
+        from source if not cached.  source is a URL (e.g. http://, ftp://,
+        file://) or path, with valid's date and time filled in as per
+        strftime, e.g. /data/cfsr/%Y/%Y%m%d%H.grb2; the file is named as the
+        last part of it.
+        """
+
+        got = self.get(dset, valid)
+        if got:
+            return got
+
+        url = valid.strftime(source)
+        name = os.path.basename(url)
+        logging.info('Fetching %s' % url)
+
+        fd, tmpName = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if '://' in url:
+                    src = urllib2.urlopen(url)
+                else:
+                    src = open(url, 'rb')
+                try:
+                    shutil.copyfileobj(src, f, 1024**2)
+                finally:
+                    src.close()
+            return name, self.put(dset, valid, name, tmpName)
+        except BaseException:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
+    def prefetch(self, dset, times, source, workers=4, keep=()):
+        """
+        Fetch dset at all times (datetimes) not already cached, workers at a
+        time, then evict whatever else is needed to get under size; never
+        those of times or keep (more datetimes, e.g. of a whole plan).
+        Returns the number fetched and a list of times that failed.
+        """
+
+        wanted = set(times)
+        missing = sorted(_ for _ in wanted if self.get(dset, _) is None)
+
+        def fetch(valid):
+            try:
+                self.fetch(dset, valid, source)
+                return valid, True
+            except (IOError, OSError, urllib2.URLError) as e:
+                logging.error('Could not fetch %s: %s' % (valid.strftime(source), e))
+                return valid, False
+
+        pool = multiprocessing.pool.ThreadPool(max(1, workers))
+        failed = [valid for valid, ok in pool.imap_unordered(fetch, missing) if not ok]
+        pool.close()
+        pool.join()
+
+        self.evict(keep=[(dset, _) for _ in wanted.union(keep)])
+
+        return len(missing)-len(failed), sorted(failed)
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used files until under size; never those
+        of keep, a list of (dset, valid datetime).
+        """
+
+        keep = set((d, v.isoformat()) for d, v in keep)
+
+        with self.lock, self.db:
+
+            rows = self.db.execute('SELECT dset, valid, sha1, size FROM files ORDER BY used').fetchall()
+
+            # Files kept once, no matter how many keys share them
+            sizes = dict((sha1, size) for d, v, sha1, size in rows)
+            total = sum(sizes.values())
+            refs = {}
+            for d, v, sha1, size in rows:
+                refs[sha1] = refs.get(sha1, 0) + 1
+
+            for d, v, sha1, size in rows:
+                if total <= self.size:
+                    break
+                if (d, v) in keep:
+                    continue
+                self.db.execute('DELETE FROM files WHERE dset=? AND valid=?', (d, v))
+                refs[sha1] -= 1
+                if refs[sha1] == 0:
+                    logging.info('Evicting %s %s from cache' % (d, v))
+                    try:
+                        os.remove(self.object(sha1))
+                    except OSError:
+                        pass
+                    total -= size
+
+        if total > self.size:
+            logging.warning('Cache %s is %.1f GB; over its size, but all are needed' % (
+                self.path, total/1024.0**3))
+
+    def link(self, dset, valid, dest, name=None):
+        """
+        Hard link (or, across filesystems, copy) cached dset at valid into
+        directory dest, under its name or, if supplied, name (with valid's
+        date and time filled in as per strftime).  Returns the path, or None
+        if not cached.
+        """
+
+        got = self.get(dset, valid)
+        if got is None:
+            return None
+
+        cached, path = got
+        fileName = os.path.join(dest, valid.strftime(name) if name else cached)
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        try:
+            os.link(path, fileName)
+        except OSError:
+            shutil.copy2(path, fileName)
+
+        return fileName
+
+    def usage(self):
+        """
+        Return number of keys, number of files and total bytes held.
+        """
+
+        with self.lock:
+            rows = self.db.execute('SELECT sha1, size FROM files').fetchall()
+        return len(rows), len(set(_[0] for _ in rows)), sum(dict(rows).values())
+
+
+def dset_times(dset, start, hours):
+    """
+    Return the analysis times of dset (every DSET_HOURS) covering start
+    (a datetime) through hours later.
+    """
+
+    step = DSET_HOURS.get(dset, 6)
+    first = start.replace(hour=start.hour - start.hour % step, minute=0, second=0, microsecond=0)
+    times = []
+    t = first
+    while t <= start + datetime.timedelta(hours=hours):
+        times.append(t)
+        t += datetime.timedelta(hours=step)
+    return times
+
+
+def main():
+    """
+    Report on, or trim, an input data cache (see ems_chunk.py --cache).
+    """
+
+    parser = argparse.ArgumentParser(
+        description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('cache', help='specify cache directory')
+
+    parser.add_argument('--size', metavar='GB', type=float,
+        help='evict least recently used files until under size')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.cache, 'index.db')):
+        print 'ERROR:  No cache in %s' % args.cache
+        raise SystemExit
+
+    with InputCache(args.cache) as cache:
+        if args.size is not None:
+            cache.size = args.size*1024**3
+            cache.evict()
+        keys, files, size = cache.usage()
+        print '%d times, %d files, %.2f GB' % (keys, files, size/1024.0**3)
+
+
+if __name__ == "__main__":
+    main()
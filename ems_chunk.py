@@ -2,13 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import glob
+import re
+import itertools
 import argparse
 import datetime
 import logging
 import shutil
+import fnmatch
+import json
+import tempfile
 import errno
 import subprocess
+import threading
+import Queue
+import collections
+import multiprocessing
+import multiprocessing.pool
+import sqlite3
+import socket
+import time
+import atexit
+import signal
+
+from ems_metrics import Metrics, metrics_file
+from ems_cache import InputCache, CACHE_SIZE, dset_times
+
+try:
+    import fcntl
+except ImportError:
+    # e.g. Windows; no reflinks
+    fcntl = None
 
 # Establish EMS_RUN
 try:
@@ -18,6 +43,37 @@ except KeyError:
     raise
 
 
+# Read-only files (relative to domain) that may be shared amongst chunks
+# rather than copied; see ems_clone
+EMS_SHARED = ('static/geo_*', '*.TBL', '*_DATA', '*.exe')
+
+# Where ems_clone notes what it has shared
+EMS_SHARED_FILE = '.ems_shared'
+
+# Linux ioctl to clone a file copy-on-write
+FICLONE = 0x40049409
+
+# Stages of each chunk, in order, and what (relative to its run directory)
+# each leaves behind; see ChunkState
+EMS_STAGES = (('clone', None), ('prep', 'wpsprd/met*.nc'), ('run', 'wrfprd/wrfout*'),
+              ('slim', 'wrfprd/wrfslim*'))
+
+# Seconds a worker's claim on a chunk lasts without a heartbeat; see ChunkQueue
+EMS_LEASE = 600
+
+# Where the output of UEMS commands goes, in the directory each is run in
+EMS_CALL_LOG = 'ems_call.log'
+
+# Seconds a timed out UEMS command is given to stop before being killed
+EMS_GRACE = 30
+
+# Seconds to wait before retrying a failed stage; doubled each time
+EMS_BACKOFF = 60
+
+# Exit status of the last UEMS command run by this thread; see ems_call
+EMS_LAST = threading.local()
+
+
 def ems_run_dir():
     """
     Return the EMS_RUN environment variable
@@ -29,32 +85,155 @@ def ems_run_dir():
         raise SystemExit
 
 
+def ems_confs(domain, changes):
+    """
+    Modify conf files in one go.
+    changes is a dictionary of conf name to a dictionary of key, value pairs
+    e.g. {'physics': {'MP_PHYSICS': 6, 'SF_SFCLAY_PHYSICS': 1}}.
+    Each conf file is read once, modified in memory, and atomically replaced.
+    Returns a dictionary of conf name to the set of keys actually found.
+    """
+
+    found = {}
+
+    for conf, vals in changes.items():
+
+        path = os.path.join(domain, 'conf', 'ems_run', 'run_' + conf + '.conf')
+
+        with open(path) as f:
+            lines = f.readlines()
+
+        # Replace any line setting one of our keys
+        found[conf] = set()
+        for n, line in enumerate(lines):
+            match = re.match(r'[ \t]*(\w+)[ \t]*=', line)
+            if match and match.group(1) in vals:
+                key = match.group(1)
+                lines[n] = '%s = %s\n' % (key, str(vals[key]))
+                found[conf].add(key)
+                logging.info('Modifying %s = %s' % (key, str(vals[key])))
+
+        for key in sorted(set(vals) - found[conf]):
+            logging.warning('NOT modifying %s; not found in %s' % (key, path))
+
+        # Write alongside and swap in so that file is never half-written
+        fd, tmp = tempfile.mkstemp(prefix='.run_' + conf, dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        shutil.copymode(path, tmp)
+        os.rename(tmp, path)
+
+    return found
+
+
+def ems_locfil(dset):
+    """
+    Return the name (as per strftime of the analysis time) ems_prep looks
+    for dset's files under in a run's grib directory; that of LOCFIL in its
+    gribinfo file under EMS_CONF, e.g. YYMMDDCC.cfsr.tCCz.pgrbhFF.grb2 gives
+    %y%m%d%H.cfsr.t%Hz.pgrbh00.grb2.
+    Returns None if not found.
+    """
+
+    if 'EMS_CONF' not in os.environ:
+        return None
+
+    for d in ['gribinfo', 'grib_info']:
+        fileName = os.path.join(os.environ['EMS_CONF'], d, '%s_gribinfo.conf' % dset)
+        if not os.path.isfile(fileName):
+            continue
+        with open(fileName) as f:
+            for line in f:
+                match = re.match(r'[ \t]*LOCFIL[ \t]*=[ \t]*(\S+)', line)
+                if match:
+                    name = match.group(1)
+                    # Analyses; no forecast hours
+                    for key, val in [('YYYY', '%Y'), ('YY', '%y'), ('MM', '%m'), ('DD', '%d'),
+                                     ('CC', '%H'), ('HH', '%H'), ('FFF', '000'), ('FF', '00')]:
+                        name = name.replace(key, val)
+                    return name
+
+    return None
+
+
 def ems_conf(domain, conf, key, val):
     """
     Modify conf files.
+    Returns True if key was found.
     """
-    path = os.path.join(domain, 'conf', 'ems_run', 'run_' + conf + '.conf')
-
-    cmd = ['sed']
-    cmd.append('-i')
-    cmd.append(r'"s/^[ \t]*%s.*/%s = %s/"' % (key, key, str(val)))
-    cmd.append(path)
-    logging.info('Modifying %s = %s' % (key, str(val)))
-    return subprocess.call(' '.join(cmd), shell=True) == 0
+    return key in ems_confs(domain, {conf: {key: val}})[conf]
 
 
-def ems_clone(src, dest, ignore=(), force=False):
+def ems_reflink(src, dest):
+    """
+    Clone file src to dest copy-on-write, if the filesystem supports it
+    (e.g. btrfs, XFS).  Returns True if successful.
+    """
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as s:
+            with open(dest, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def ems_clone(src, dest, ignore=(), force=False, link=None, shared=EMS_SHARED):
     """
     Clone source, ignoring any glob'd files.
     e.g. ignore=('*.jpg', '*.png')
+    If link is 'hard' or 'sym', any files matching the shared globs (relative
+    to src) are not copied but reflinked (if possible) or hard-linked, or
+    symlinked, respectively.  Their sizes and times are noted in dest so that
+    ems_shared_check can later ensure nothing has written through the links.
     """
 
     if force:
         shutil.rmtree(dest, ignore_errors=True)
 
+    # Ignore user's globs and pick out read-only files to be shared
+    sharedFiles = []
+
+    def ignore_shared(d, names):
+        ignored = shutil.ignore_patterns(*ignore)(d, names)
+        if link:
+            for name in names:
+                rel = os.path.relpath(os.path.join(d, name), src)
+                if name not in ignored and os.path.isfile(os.path.join(d, name)) and \
+                        any(fnmatch.fnmatch(rel, _) for _ in shared):
+                    ignored.add(name)
+                    sharedFiles.append(rel)
+        return ignored
+
     try:
-        shutil.copytree(src, dest, ignore=shutil.ignore_patterns(*ignore))
+        shutil.copytree(src, dest, ignore=ignore_shared)
         logging.info('Copying %s to %s' % (src, dest))
+
+        # Link up the shared files
+        stats = {}
+        for rel in sharedFiles:
+            s, d = os.path.join(src, rel), os.path.join(dest, rel)
+            if link == 'sym':
+                os.symlink(os.path.abspath(s), d)
+            elif not ems_reflink(s, d):
+                try:
+                    os.link(s, d)
+                except OSError:
+                    # e.g. across filesystems
+                    shutil.copy2(s, d)
+            st = os.stat(d)
+            stats[rel] = (st.st_size, st.st_mtime)
+
+        if link:
+            with open(os.path.join(dest, EMS_SHARED_FILE), 'w') as f:
+                json.dump(stats, f)
+            logging.info('Linking %d shared files from %s' % (len(sharedFiles), src))
+
     except OSError as e:
         if e.errno == errno.ENOTDIR:
             shutil.copy(src, dest)
@@ -68,24 +247,549 @@ def ems_clone(src, dest, ignore=(), force=False):
         raise SystemError
 
 
-def ems_clean(domainDir, level=0):
+def ems_shared_check(runDir):
+    """
+    Check that none of the files shared by ems_clone have been written to
+    (through a link) since cloning.  Returns True if all is well.
+    """
+
+    try:
+        with open(os.path.join(runDir, EMS_SHARED_FILE)) as f:
+            stats = json.load(f)
+    except IOError:
+        # Nothing shared
+        return True
+
+    ok = True
+    for rel, (size, mtime) in sorted(stats.items()):
+        st = os.stat(os.path.join(runDir, rel))
+        if (st.st_size, st.st_mtime) != (size, mtime):
+            logging.error('Shared file %s modified by %s' % (rel, runDir))
+            ok = False
+
+    return ok
+
+
+def state_file(domain, host=None):
+    """
+    Return the chunk state database of domain; alongside its log.  Workers
+    (see ChunkQueue) keep one per host, as SQLite is not safe to share
+    amongst hosts over NFS.
+    """
+    return '%s.%s.db' % (domain, host) if host else '%s.db' % domain
+
+
+def state_files(domain):
+    """
+    Return all the chunk state databases of domain; that of a single run,
+    and those of each host that has had workers.
+    """
+    return glob.glob(state_file(domain)) + sorted(glob.glob(state_file(domain, '*')))
+
+
+class ChunkState(object):
+    """
+    Durable record, in SQLite, of each chunk's plan (as per ems_index), and
+    of each stage's status (running, done or failed), exit status, attempts,
+    times and the sizes of the files it left behind.
+    Safe to share amongst threads.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chunks (
+            run_dir TEXT PRIMARY KEY, idx INTEGER, spinup_date TEXT,
+            start_date TEXT, end_date TEXT, hours INTEGER, planned TEXT);
+        CREATE TABLE IF NOT EXISTS stages (
+            run_dir TEXT, stage TEXT, status TEXT, exit_code INTEGER,
+            attempts INTEGER DEFAULT 0, started TEXT, finished TEXT,
+            PRIMARY KEY (run_dir, stage));
+        CREATE TABLE IF NOT EXISTS outputs (
+            run_dir TEXT, stage TEXT, path TEXT, size INTEGER, mtime REAL,
+            PRIMARY KEY (run_dir, stage, path));
+        CREATE TABLE IF NOT EXISTS events (
+            run_dir TEXT, stage TEXT, status TEXT, exit_code INTEGER, time TEXT);
+    """
+
+    def __init__(self, fileName):
+        """
+        Open (creating if need be) state database fileName.
+        """
+
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fileName, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def now():
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+
+    def plan(self, runDir, chunk):
+        """
+        Note chunk (as per ems_index) is done in runDir.
+        """
+
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, '
+                'COALESCE((SELECT planned FROM chunks WHERE run_dir=?), ?))',
+                (runDir, chunk['index'], chunk['spinupDate'].isoformat(),
+                 chunk['startDate'].isoformat(), chunk['endDate'].isoformat(),
+                 chunk['hours'], runDir, self.now()))
+
+    def start(self, runDir, stage):
+        """
+        Note stage of runDir is running.
+        """
+
+        now = self.now()
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR IGNORE INTO stages (run_dir, stage) VALUES (?, ?)', (runDir, stage))
+            self.db.execute(
+                'UPDATE stages SET status=?, exit_code=NULL, attempts=attempts+1, started=?, '
+                'finished=NULL WHERE run_dir=? AND stage=?', ('running', now, runDir, stage))
+            self.db.execute('DELETE FROM outputs WHERE run_dir=? AND stage=?', (runDir, stage))
+            self.db.execute('INSERT INTO events VALUES (?, ?, ?, NULL, ?)',
+                            (runDir, stage, 'running', now))
+
+    def finish(self, runDir, stage, ok, exitCode=None, outputs=()):
+        """
+        Note stage of runDir is done (if ok) or failed, with the exit status
+        of its command (if run), and the sizes of the outputs it left.
+        """
+
+        now = self.now()
+        status = 'done' if ok else 'failed'
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE stages SET status=?, exit_code=?, finished=? WHERE run_dir=? AND stage=?',
+                (status, exitCode, now, runDir, stage))
+            for path in outputs:
+                st = os.stat(path)
+                self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                                (runDir, stage, path, st.st_size, st.st_mtime))
+            self.db.execute('INSERT INTO events VALUES (?, ?, ?, ?, ?)',
+                            (runDir, stage, status, exitCode, now))
+
+    def drop(self, runDir, stage, path):
+        """
+        Forget output path of stage of runDir; e.g. it was deliberately removed.
+        """
+
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM outputs WHERE run_dir=? AND stage=? AND path=?',
+                            (runDir, stage, path))
+
+    def done(self, runDir, stage):
+        """
+        Return True if stage of runDir is done and its outputs are as it
+        left them, False if it is not (e.g. was left running by a crash, or
+        failed), or None if it has never been attempted.
+        """
+
+        with self.lock:
+            row = self.db.execute('SELECT status FROM stages WHERE run_dir=? AND stage=?',
+                                  (runDir, stage)).fetchone()
+            outputs = self.db.execute('SELECT path, size FROM outputs WHERE run_dir=? AND stage=?',
+                                      (runDir, stage)).fetchall()
+
+        if row is None:
+            return None
+
+        if row[0] != 'done':
+            return False
+
+        if stage == 'clone' and not os.path.isdir(runDir):
+            return False
+
+        for path, size in outputs:
+            try:
+                if os.path.getsize(path) != size:
+                    logging.warning('%s changed since %s %s' % (path, stage, runDir))
+                    return False
+            except OSError:
+                logging.warning('%s missing since %s %s' % (path, stage, runDir))
+                return False
+
+        return True
+
+    def status(self):
+        """
+        Return a list, in date order, of each chunk's run directory, start
+        date, and a dictionary of stage to (status, exit status, attempts,
+        finished or started time).
+        """
+
+        with self.lock:
+            chunks = self.db.execute('SELECT run_dir, start_date FROM chunks '
+                                     'ORDER BY start_date').fetchall()
+            rows = self.db.execute('SELECT run_dir, stage, status, exit_code, attempts, '
+                                   'COALESCE(finished, started) FROM stages').fetchall()
+
+        stages = {}
+        for row in rows:
+            stages.setdefault(row[0], {})[row[1]] = row[2:]
+
+        return [(runDir, startDate, stages.get(runDir, {})) for runDir, startDate in chunks]
+
+
+def ems_status(chunks):
+    """
+    Print the status of chunks (as per ChunkState.status) and a tally.
+    """
+
+    names = [_ for _, __ in EMS_STAGES]
+    print '%-28s %-11s' % ('chunk', 'start') + ''.join('%-9s' % _ for _ in names) + \
+        '%-9s %5s  %s' % ('attempts', 'exit', 'updated')
+
+    tally = collections.Counter()
+    for runDir, startDate, stages in chunks:
+
+        # Overall status is that of the latest stage attempted
+        latest = [_ for _ in names if _ in stages]
+        if latest:
+            status, exitCode, attempts, updated = stages[latest[-1]]
+            overall = '%s %s' % (latest[-1], status)
+        else:
+            status, exitCode, attempts, updated = 'planned', None, 0, ''
+            overall = 'planned'
+        tally[overall] += 1
+
+        print '%-28s %-11s' % (os.path.basename(runDir), startDate[:10]) + \
+            ''.join('%-9s' % (stages[_][0] if _ in stages else '-') for _ in names) + \
+            '%-9d %5s  %s' % (attempts or 0, '-' if exitCode is None else exitCode, updated or '')
+
+    print
+    print '%d chunks: %s' % (len(chunks), ', '.join('%d %s' % (n, overall) for overall, n in sorted(tally.items())))
+
+
+class ChunkQueue(object):
+    """
+    Chunks shared out amongst any number of workers, on any number of hosts,
+    through lock files in a directory on the (shared) EMS_RUN.
+    A worker claims a chunk by creating its lock file (atomically, even on
+    NFS), keeps the claim alive by touching it every so often, and, once
+    finished, marks the chunk done and removes the lock.  A claim not
+    touched in lease seconds is that of a dead worker and may be taken over.
+    Times are those of the file server, so hosts' clocks needn't agree.
+    """
+
+    def __init__(self, path, lease=EMS_LEASE):
+        """
+        Share chunks through directory path (created if need be).
+        """
+
+        self.path = path
+        self.lease = lease
+        self.worker = '%s.%d' % (socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.held = set()
+        self.tried = set()
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Keep claims alive
+        self.stopped = threading.Event()
+        self.beat = threading.Thread(target=self.heartbeat)
+        self.beat.daemon = True
+        self.beat.start()
+
+    def file(self, name, ext):
+        return os.path.join(self.path, '%s.%s' % (name, ext))
+
+    def now(self):
+        """
+        Return the file server's time.
+        """
+
+        clock = self.file(self.worker, 'clock')
+        with open(clock, 'w'):
+            pass
+        t = os.path.getmtime(clock)
+        os.remove(clock)
+        return t
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.lease/4.0):
+            with self.lock:
+                held = list(self.held)
+            for name in held:
+                try:
+                    os.utime(self.file(name, 'lock'), None)
+                except OSError:
+                    logging.error('Lost claim on %s' % name)
+
+    def done(self, name, marks=('run',)):
+        """
+        Return True if chunk name has been marked as any of marks.
+        """
+        return any(os.path.exists(self.file(name, _)) for _ in marks)
+
+    def claim(self, name):
+        """
+        Claim chunk name, returning False if another worker has it, True if
+        free, or 'reclaimed' if taken over from a dead worker or marked redo
+        (and so may have been left half done).
+        """
+
+        lock = self.file(name, 'lock')
+        redo = self.file(name, 'redo')
+        reclaimed = False
+        for attempt in range(2):
+
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'worker': self.worker, 'claimed': self.now()}, f)
+                with self.lock:
+                    self.held.add(name)
+                    self.tried.add(name)
+                if os.path.exists(redo):
+                    os.remove(redo)
+                    reclaimed = True
+                return 'reclaimed' if reclaimed else True
+
+            try:
+                if self.now() - os.path.getmtime(lock) < self.lease:
+                    return False
+            except OSError:
+                # Just released
+                continue
+
+            # Break the dead worker's claim; only one worker's rename wins
+            stale = self.file(name, '%s.stale' % self.worker)
+            try:
+                os.rename(lock, stale)
+            except OSError:
+                return False
+
+            # Unless, in the meantime, it was broken and claimed afresh by
+            # another worker, in which case it is put back
+            if self.now() - os.path.getmtime(stale) < self.lease:
+                try:
+                    os.link(stale, lock)
+                except OSError:
+                    pass
+                os.remove(stale)
+                return False
+
+            with open(stale) as f:
+                logging.warning('Reclaiming %s from dead worker %s' % (name, f.read()))
+            os.remove(stale)
+            reclaimed = True
+
+        return False
+
+    def release(self, name, mark=None):
+        """
+        Give up claim (if held) on chunk name, marking it (e.g. as prep or
+        run done, or redo if left half done) if supplied.
+        """
+
+        with self.lock:
+            if name not in self.held:
+                return
+            self.held.discard(name)
+        if mark:
+            with open(self.file(name, mark), 'w') as f:
+                f.write(self.worker)
+        try:
+            os.remove(self.file(name, 'lock'))
+        except OSError:
+            pass
+
+    def claims(self, chunks, key, slots, marks=('run',)):
+        """
+        Generate (chunk, claim) for each of chunks (named by key) not yet
+        marked and claimed, once one of slots (a semaphore, released by the
+        caller when done with the chunk) is free.  Chunks claimed by others
+        are come back to until done, in case their workers die; none is
+        tried more than once.
+        """
+
+        pending = list(chunks)
+        while pending:
+            waiting = []
+            for chunk in pending:
+                name = key(chunk)
+                if name in self.tried or self.done(name, marks):
+                    continue
+                slots.acquire()
+                claim = self.claim(name)
+                if claim:
+                    yield chunk, claim
+                else:
+                    slots.release()
+                    waiting.append(chunk)
+            pending = waiting
+            if pending:
+                time.sleep(min(60, self.lease/4.0))
+
+    def close(self):
+        """
+        Stop the heartbeat, giving up any claims still held as half done.
+        """
+
+        self.stopped.set()
+        self.beat.join()
+        with self.lock:
+            held = list(self.held)
+        for name in held:
+            self.release(name, 'redo')
+
+
+def ems_kill(p, grace=EMS_GRACE):
+    """
+    Terminate child process p (a subprocess.Popen) and everything it started,
+    killing them outright if still around after grace seconds.
+    """
+
+    def gone(sig=0):
+        # Whether the group has gone (so p.pid may be reused), else signal it
+        try:
+            os.killpg(p.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            return True
+        return False
+
+    if p.returncode is not None or gone(signal.SIGTERM):
+        return
+
+    # Killed outright even if it has itself gone, as what it started (e.g.
+    # mpirun's children) may not have, keeping its output pipes open.  Until
+    # p is reaped (by whoever waits on it, so not polled here) or while any
+    # of the group remains, p.pid cannot be reused
+    end = time.time()+grace
+    while not (p.returncode is not None and gone()):
+        if time.time() >= end:
+            gone(signal.SIGKILL)
+            return
+        time.sleep(min(0.1, end-time.time()))
+
+
+def ems_stream(src, log, lock):
+    """
+    Copy src (a pipe) to log, a line at a time as it comes.
+    """
+
+    for line in iter(src.readline, ''):
+        with lock:
+            log.write(line)
+    src.close()
+
+
+def ems_call(cmd, cwd, metrics=None, timeout=None):
+    """
+    Run UEMS command (a list of arguments; no shell) in cwd, returning True
+    if successful.  Its output is appended, line by line as it comes, to
+    EMS_CALL_LOG in cwd.
+    If it runs for longer than timeout seconds, it (and whatever it started,
+    e.g. mpirun) is terminated.
+    If metrics (see ems_metrics) supplied, its resource use is added to the
+    current stage.
+    Its exit status is kept in EMS_LAST.status.
+    """
+
+    with open(os.path.join(cwd, EMS_CALL_LOG), 'a') as log:
+
+        lock = threading.Lock()
+        log.write('# %s %s\n' % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                  ' '.join(cmd)))
+        log.flush()
+
+        # In a process group of its own, so all of it can be stopped
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             close_fds=True, preexec_fn=os.setsid)
+        streams = [threading.Thread(target=ems_stream, args=(_, log, lock))
+                   for _ in [p.stdout, p.stderr]]
+        for stream in streams:
+            stream.start()
+
+        watchdog = None
+        expired = []
+        if timeout:
+            watchdog = threading.Timer(timeout, lambda: expired.append(True) or ems_kill(p))
+            watchdog.daemon = True
+            watchdog.start()
+
+        try:
+            if metrics:
+                EMS_LAST.status = metrics.wait(p)
+            else:
+                EMS_LAST.status = p.wait()
+        except BaseException:
+            # e.g. Ctrl-C; it would otherwise carry on regardless
+            ems_kill(p, grace=0)
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            for stream in streams:
+                stream.join()
+
+        if expired:
+            logging.error('Timed out after %g s: %s in %s' % (timeout, ' '.join(cmd), cwd))
+            log.write('# Timed out after %g s\n' % timeout)
+
+        log.write('# Exit status %d\n' % EMS_LAST.status)
+
+    return EMS_LAST.status == 0
+
+
+def ems_clean(domainDir, level=0, metrics=None):
     """
     Wrapper to call ems_clean
     """
     cmd = ['ems_clean']
-    cmd.append('--level %d' % level)
+    cmd.extend(['--level', '%d' % level])
     logging.info('Cleaning %s' % (domainDir))
-    return subprocess.call(' '.join(cmd), shell=True, cwd=domainDir) == 0
+    return ems_call(cmd, domainDir, metrics)
+
+
+def ems_slim(runDir, wrfFile, variables=None, metrics=None):
+    """
+    Write the slim companion of wrfFile holding only WRF variables (see
+    ems_dechunk.slim) in a Python process of its own, as netCDF (HDF5) is
+    not safe to use from the threads of concurrent chunks.
+    """
+    cmd = [sys.executable, '-c',
+           'import sys, logging; logging.basicConfig(); sys.path.insert(0, sys.argv[1]); '
+           'import ems_dechunk; ems_dechunk.slim(sys.argv[2], sys.argv[3:] or None)',
+           os.path.dirname(os.path.abspath(__file__)), wrfFile]
+    cmd.extend(variables or [])
+    logging.info('Slimming %s' % wrfFile)
+    return ems_call(cmd, runDir, metrics)
 
 
-def ems_update(domainDir):
+def ems_update(domainDir, metrics=None):
     """
     Wrapper to call ems_domain.pl --update
     """
     cmd = ['ems_domain.pl']
     cmd.append('--update')
     logging.info('Updating %s' % (domainDir))
-    return subprocess.call(' '.join(cmd), shell=True, cwd=domainDir) == 0
+    return ems_call(cmd, domainDir, metrics)
 
 
 def ems_index(d, chunkDays=3, spinupHours=12):
@@ -140,9 +844,30 @@ def ems_index(d, chunkDays=3, spinupHours=12):
     }
 
 
-def ems_prep(runDir, date, nDomains=3, dset='cfsr', length=84, cycle=12, nudge=True, nfs=False, force=False):
+def ems_plan(startDate, endDate, chunkDays=3, spinupHours=12):
+    """
+    Return the list of chunks (as per ems_index) needed to cover startDate
+    through endDate.
+    """
+
+    chunks = []
+    d = startDate
+    while d < endDate:
+
+        # Determine chunk id, start, end, and length
+        chunk = ems_index(d, chunkDays=chunkDays, spinupHours=spinupHours)
+        chunks.append(chunk)
+
+        # Move the sticks
+        d = chunk['endDate']
+
+    return chunks
+
+
+def ems_prep(runDir, date, nDomains=3, dset='cfsr', length=84, cycle=12, nudge=True, nfs=False, force=False,
+             metrics=None, timeout=None):
     """
-    Run ems_prep.pl with great excitement.
+    Run ems_prep.pl with great excitement, but for no more than timeout seconds.
     """
 
     # Check if metgrid files already exist.  If so, skip prep
@@ -153,49 +878,49 @@ def ems_prep(runDir, date, nDomains=3, dset='cfsr', length=84, cycle=12, nudge=T
             return True
 
     cmd = ['ems_prep.pl']
-    cmd.append('--domain %s' % ','.join([str(_) for _ in range(1,nDomains+1)]))
+    cmd.extend(['--domain', ','.join([str(_) for _ in range(1,nDomains+1)])])
     if nfs:
-        cmd.append('--dset %s:nfs' % dset)
+        cmd.extend(['--dset', '%s:nfs' % dset])
     else:
-        cmd.append('--dset %s' % dset)
+        cmd.extend(['--dset', dset])
 
-    cmd.append('--length %d' % length)
+    cmd.extend(['--length', '%d' % length])
     cmd.append('--analysis')
-    cmd.append('--date %04d%02d%02d' % (date.year, date.month, date.day))
-    cmd.append('--cycle %02d' % cycle)
+    cmd.extend(['--date', '%04d%02d%02d' % (date.year, date.month, date.day)])
+    cmd.extend(['--cycle', '%02d' % cycle])
 
     if nudge:
         cmd.append('--nudge')
 
     logging.info("Prepping %s" % runDir)
 
-    return subprocess.call(' '.join(cmd), shell=True, cwd=runDir) == 0
+    return ems_call(cmd, runDir, metrics, timeout=timeout)
 
 
-def ems_run(runDir, nDomains=3, nudge=True, nodes=None, force=False):
+def ems_run(runDir, nDomains=3, nudge=True, nodes=None, force=False, metrics=None, timeout=None):
     """
-    Run ems_run.pl with all proper gravitas.
+    Run ems_run.pl with all proper gravitas, but for no more than timeout seconds.
     """
 
-    # Check if wrfout files already exist.  If so, skip run
+    # Check if wrfout files (or their slim companions) already exist.  If so, skip run
     if not force:
-        wrf = glob.glob('%s/wrfprd/wrfout*' % runDir)
+        wrf = glob.glob('%s/wrfprd/wrfout*' % runDir) + glob.glob('%s/wrfprd/wrfslim*' % runDir)
         if len(wrf) > 0:
             logging.info("NOT running %s; use the force Luke" % runDir)
             return True
 
     cmd = ['ems_run.pl']
-    cmd.append('--domain %s' % ','.join([str(_) for _ in range(1, nDomains+1)]))
+    cmd.extend(['--domain', ','.join([str(_) for _ in range(1, nDomains+1)])])
 
     if nodes:
-        cmd.append('--nodes %d' % nodes)
+        cmd.extend(['--nodes', '%d' % nodes])
 
     if nudge:
         cmd.append('--nudge')
 
     logging.info("Running %s" % runDir)
 
-    return subprocess.call(' '.join(cmd), shell=True, cwd=runDir) == 0
+    return ems_call(cmd, runDir, metrics, timeout=timeout)
 
 def main():
 
@@ -211,12 +936,33 @@ def main():
     parser.add_argument('domain',
         help='specify master localized domain directory')
 
-    parser.add_argument('start_date',
+    parser.add_argument('start_date', nargs='?',
         help='specify starting YYYYMMDD')
 
-    parser.add_argument('end_date',
+    parser.add_argument('end_date', nargs='?',
         help='specify ending date YYYYMMDD')
 
+    parser.add_argument('--status', action='store_true',
+        help='report the status of each chunk (from the state database) and exit')
+
+    parser.add_argument('--retry', metavar='int', default=0, type=int,
+        help='specify number of times to retry a failed clone, prep or run')
+
+    parser.add_argument('--backoff', metavar='seconds', default=EMS_BACKOFF, type=float,
+        help='specify how long to wait before the first retry; doubled for each one after')
+
+    parser.add_argument('--preptimeout', metavar='hours', type=float,
+        help='specify how long a prep may take before it is stopped (and failed)')
+
+    parser.add_argument('--runtimeout', metavar='hours', type=float,
+        help='specify how long a run may take before it is stopped (and failed)')
+
+    parser.add_argument('-w', '--worker', action='store_true',
+        help='share the chunks out amongst all workers (on any hosts sharing EMS_RUN) given the same domain and dates')
+
+    parser.add_argument('--lease', metavar='seconds', default=EMS_LEASE, type=int,
+        help='specify how long a dead worker keeps its claim on a chunk before it is taken over')
+
     parser.add_argument('-f', '--force', action='store_true',
         help='force cleaning, copying, prep and run')
 
@@ -230,11 +976,38 @@ def main():
         help='specify how many nests to use; will use all available if not supplied')
 
     parser.add_argument('--nodes', type=int,
-        help='specify number of nodes/processes; will use all CPUs available if not supplied')
+        help='specify total number of nodes/processes; will use all CPUs available if not supplied')
+
+    parser.add_argument('-c', '--concurrent', metavar='int', default=1, type=int,
+        help='specify number of chunks to run at once; nodes are shared evenly amongst them')
+
+    parser.add_argument('-p', '--prepahead', metavar='int', default=0, type=int,
+        help='specify number of chunks to prep in the background ahead of those running')
+
+    parser.add_argument('--prepnodes', metavar='int', default=1, type=int,
+        help='specify number of nodes reserved for background prep')
 
     #~ parser.add_argument('--spinup', metavar='hours', default=12,
         #~ type=int, help='specify spin-up time in hours')
 
+    parser.add_argument('-l', '--link', choices=['hard', 'sym'],
+        help='share read-only files (e.g. static/geo_em*) with master via hard (or reflink) or symbolic links rather than copying')
+
+    parser.add_argument('--cache', metavar='dir',
+        help='specify a directory to keep input data in, shared by all chunks (and domains) using it')
+
+    parser.add_argument('--cachesize', metavar='GB', default=CACHE_SIZE, type=float,
+        help='specify how big the input data cache may get before the least recently used are removed')
+
+    parser.add_argument('--source', metavar='url',
+        help='specify where to fetch input data into the cache from, with dates as per strftime e.g. http://server/cfsr/%%Y%%m/%%Y%%m%%d%%H.grb2')
+
+    parser.add_argument('--slim', metavar='var', nargs='*',
+        help='once run, write a slim compressed copy (wrfslim*) of the wrfout files holding only WRF variables var; those ems_dechunk.py needs if none given')
+
+    parser.add_argument('--prune', action='store_true',
+        help='remove the full wrfout files once slimmed')
+
     parser.add_argument('--levels', metavar='int', default=45,
         type=int, help='specify number of vertical levels/layers')
 
@@ -243,6 +1016,28 @@ def main():
 
     args = parser.parse_args()
 
+    # Report what has been done without looking at any run directories
+    if args.status:
+        fileNames = state_files(args.domain)
+        if not fileNames:
+            print 'ERROR:  No chunks of %s recorded in %s' % (args.domain, state_file(args.domain))
+            raise SystemExit
+
+        # Of chunks done by workers on several hosts (e.g. reclaimed from
+        # a dead one), the latest word on each
+        chunks = {}
+        for fileName in fileNames:
+            with ChunkState(fileName) as state:
+                for chunk in state.status():
+                    updated = max([_[3] or '' for _ in chunk[2].values()] or [''])
+                    if chunk[0] not in chunks or updated >= chunks[chunk[0]][0]:
+                        chunks[chunk[0]] = (updated, chunk)
+        ems_status(sorted([_[1] for _ in chunks.values()], key=lambda _: _[1]))
+        return
+
+    if not args.start_date or not args.end_date:
+        parser.error('start_date and end_date are required')
+
     # Point logging to domain.log
     logging.basicConfig(filename='%s.log' % args.domain, level=logging.INFO,
         format='%(asctime)s - %(message)s')
@@ -261,16 +1056,42 @@ def main():
             #~ print 'WARNING:  Overriding desire to use NFS for', args.dset
             #~ args.nfs = False
 
+    # Keep track of time and resources each stage takes
+    metrics = Metrics(metrics_file(args.domain), script='ems_chunk', domain=args.domain)
+
+    # The first worker readies the master, marking it ready for the rest
+    # (which wait on it), then all claim chunks in turn
+    if args.worker:
+        if args.force:
+            print 'ERROR:  Cannot force with --worker; remove %s.queue (and the chunks) to start afresh' % args.domain
+            raise SystemExit
+        queue = ChunkQueue(os.path.join(EMS_RUN, '%s.queue' % args.domain), lease=args.lease)
+        atexit.register(queue.close)
+        while not queue.done(args.domain, ('ready',)) and not queue.claim(args.domain):
+            time.sleep(1)
+        ready = queue.done(args.domain, ('ready',))
+        if ready:
+            queue.release(args.domain)
+            logging.info('NOT readying %s; ready' % domainDir)
+    else:
+        queue = None
+        ready = False
+
     # Sanitize and re-localize the directory, just to be sure;
     if args.force:
-        if not ems_clean(domainDir, level=6):
+        with metrics.stage('ems_clean') as m:
+            m['ok'] = ems_clean(domainDir, level=6, metrics=metrics)
+        if not m['ok']:
             print 'ERROR: problem sanitizing %s' % domainDir
             raise SystemExit
 
     # Update the config files; they can get (easily) corrupted
-    if not ems_update(domainDir):
-        print 'ERROR: updating config files' % domainDir
-        raise SystemExit
+    if not ready:
+        with metrics.stage('ems_update') as m:
+            m['ok'] = ems_update(domainDir, metrics=metrics)
+        if not m['ok']:
+            print 'ERROR: updating config files of %s' % domainDir
+            raise SystemExit
 
     # Figure out the number of domains
     geo = glob.glob('%s/static/geo*.nc' % domainDir)
@@ -289,39 +1110,49 @@ def main():
             raise SystemExit
         nDomains = args.nest
 
+    # Collect up all changes to the config files
+    confs = {'wrfout': {}, 'levels': {}, 'physics': {}}
+
     # Adjust frequency of output to hourly (60 minutes)
-    ems_conf(domainDir, 'wrfout', 'HISTORY_INTERVAL', 60)
+    confs['wrfout']['HISTORY_INTERVAL'] = 60
 
     # All hour frames will clumped into one file
-    ems_conf(domainDir, 'wrfout', 'FRAMES_PER_OUTFILE', 999)
+    confs['wrfout']['FRAMES_PER_OUTFILE'] = 999
 
     # Adjust number of vertical levels; default is 45
-    ems_conf(domainDir, 'levels', 'LEVELS', args.levels)
+    confs['levels']['LEVELS'] = args.levels
 
     # Adjust the pressure of the topmost level if NARR
     if 'narr' in args.dset:
-        ems_conf(domainDir, 'levels', 'PTOP', 10000)
+        confs['levels']['PTOP'] = 10000
 
     # Adjust cumulus scheme
     # Use Kain-Fritsch only on domains with >= 10km i.e. d01 & d02
     # Use no cumulus schemes for d03, d04
     domain_str = ','.join([str(d) for d in [1, 1, 0, 0][0:nDomains]])
-    ems_conf(domainDir, 'physics', 'CU_PHYSICS', domain_str)
+    confs['physics']['CU_PHYSICS'] = domain_str
 
     # Adjust microphysics scheme
     # Use Lin et al. scheme
-    ems_conf(domainDir, 'physics', 'MP_PHYSICS', 6)
+    confs['physics']['MP_PHYSICS'] = 6
 
     # Adjust surface layer scheme
     # Use Monin-Obukhov similarity theory
-    ems_conf(domainDir, 'physics', 'SF_SFCLAY_PHYSICS', 1)
+    confs['physics']['SF_SFCLAY_PHYSICS'] = 1
 
     # Adjust LW & RW schemes TO RRTMG and
     # Add monthly/latitudinal CAM ozone profiles
     # TODO:  Add aerosol options
-    #~ ems_conf(domainDir, 'physics', 'RA_LW_PHYSICS', 24)
-    #~ ems_conf(domainDir, 'physics', 'RA_SW_PHYSICS', 24)
-    #~ ems_conf(domainDir, 'physics', 'O3_INPUT', 2)
+    #~ confs['physics']['RA_LW_PHYSICS'] = 24
+    #~ confs['physics']['RA_SW_PHYSICS'] = 24
+    #~ confs['physics']['O3_INPUT'] = 2
+
+    # Apply them
+    if not ready:
+        ems_confs(domainDir, confs)
+
+    if queue and not ready:
+        queue.release(args.domain, 'ready')
 
     # Set spin-up time
     #spinupHours = args.spinup
@@ -331,37 +1162,289 @@ def main():
     startDate = datetime.datetime.strptime(args.start_date, '%Y%m%d')
     endDate = datetime.datetime.strptime(args.end_date, '%Y%m%d')
 
-    # Iteration over all chunks
-    d = startDate
-    while d < endDate:
+    # All the chunks to be done
+    chunks = ems_plan(startDate, endDate, spinupHours=spinupHours)
 
-        # Determine chunk id, start, end, and length
-        chunk = ems_index(d, spinupHours=spinupHours)
+    # Set aside some nodes/processes for prepping in the background
+    if args.prepahead > 0:
+        nodes = (args.nodes or multiprocessing.cpu_count()) - args.prepnodes
+        if nodes < 1:
+            print 'ERROR: No nodes left to run once %d reserved for prep.' % args.prepnodes
+            raise SystemExit
+        logging.info('Prepping up to %d chunks ahead on %d reserved nodes' % (args.prepahead, args.prepnodes))
+    else:
+        nodes = args.nodes
 
-        # Create a run directory name
-        runDir = os.path.join(EMS_RUN, '%s_%04d%02d%02d' % (
+    # Share the nodes/processes out amongst the concurrent chunks
+    if args.concurrent > 1:
+        nodes = nodes or multiprocessing.cpu_count()
+        if nodes < args.concurrent:
+            print 'ERROR: Need at least one node per concurrent chunk.'
+            raise SystemExit
+        nodes /= args.concurrent
+        logging.info('Running %d chunks at a time with %d nodes each' % (args.concurrent, nodes))
+
+    # Hours simulated by each chunk's run directory
+    hours = {}
+
+    # Input data shared amongst chunks; fetched all in one go, unless
+    # sharing chunks with other workers, in which case as each is prepped.
+    # Nothing the plan needs is ever evicted to make room
+    if args.cache:
+        cache = InputCache(args.cache, size=args.cachesize*1024**3)
+        locfil = ems_locfil(args.dset)
+        if locfil is None:
+            print 'WARNING:  No LOCFIL for %s under EMS_CONF; input data is linked under its own name, which ems_prep may not look for' % args.dset
+        planTimes = sorted(set(itertools.chain(*[
+            dset_times(args.dset, _['spinupDate'], _['hours']) for _ in chunks])))
+        if args.source and not queue:
+            with metrics.stage('ems_prefetch', path=args.cache) as m:
+                fetched, failed = cache.prefetch(args.dset, planTimes, args.source)
+                m['ok'] = not failed
+            logging.info('Fetched %d of %d %s times into %s' % (fetched, len(planTimes), args.dset, args.cache))
+            if failed:
+                print 'WARNING:  Could not fetch %d %s times; see log' % (len(failed), args.dset)
+    else:
+        cache = None
+        planTimes = []
+        locfil = None
+
+    # Seconds prep and run may take
+    prepTimeout = args.preptimeout*3600 if args.preptimeout else None
+    runTimeout = args.runtimeout*3600 if args.runtimeout else None
+
+    # Where each chunk is at, should we be stopped
+    state = ChunkState(state_file(args.domain, socket.gethostname() if queue else None))
+
+    def chunk_stage(runDir, stage, do, force=False):
+        """
+        Do stage of the chunk in runDir; do is called with whether to force
+        it and returns True if successful.  Skipped if already done (and its
+        outputs untouched), forced if left running (e.g. by a crash) or
+        failed as partial outputs may remain, and retried if it fails.
+        Chunks never seen before fall back on the checks of ems_prep etc.
+        Should it raise an exception while other chunks are on the go at the
+        same time, it fails (so that they can carry on) rather than raise.
+        Returns whether successful and whether forced.
+        """
+
+        done = state.done(runDir, stage)
+        force = force or args.force or done is False
+        if done and not force:
+            logging.info('NOT doing %s of %s; done' % (stage, runDir))
+            return True, False
+
+        outputs = dict(EMS_STAGES)[stage]
+        for attempt in range(1, args.retry+2):
+
+            state.start(runDir, stage)
+            EMS_LAST.status = None
+            try:
+                ok = do(force or attempt > 1)
+            except Exception:
+                if args.concurrent == 1:
+                    state.finish(runDir, stage, False)
+                    raise
+                logging.exception('Exception in %s of %s' % (stage, runDir))
+                ok = False
+
+            # A stage that leaves nothing behind has not succeeded
+            paths = glob.glob(os.path.join(runDir, outputs)) if outputs else []
+            ok = ok and (not outputs or len(paths) > 0)
+            state.finish(runDir, stage, ok, EMS_LAST.status, paths)
+            if ok:
+                break
+
+            logging.warning('Failed %s of %s (exit %s); attempt %d of %d' % (
+                stage, runDir, EMS_LAST.status, attempt, args.retry+1))
+
+            # Give whatever went wrong (e.g. a data server) a chance to recover
+            if attempt <= args.retry:
+                time.sleep(args.backoff*2**(attempt-1))
+
+        return ok, force or attempt > 1
+
+    def chunk_dir(chunk):
+        """
+        Create a run directory name
+        """
+        return os.path.join(EMS_RUN, '%s_%04d%02d%02d' % (
             args.domain, chunk['startDate'].year, chunk['startDate'].month,
             chunk['startDate'].day
         ))
 
+    def chunk_prep(claimed):
+        """
+        Clone and prep a single chunk; from scratch if reclaimed from a
+        dead worker.
+        """
+
+        chunk, claim = claimed
+        runDir = chunk_dir(chunk)
+        hours[runDir] = chunk['hours']
+        state.plan(runDir, chunk)
+
         # Clone master (if needed)
-        ems_clone(domainDir, runDir, ignore=('*.jpg',), force=args.force)
+        def clone(force):
+            with metrics.stage('ems_clone', path=runDir, chunk=runDir):
+                ems_clone(domainDir, runDir, ignore=('*.jpg', EMS_CALL_LOG), force=force,
+                          link=args.link)
+            return True
 
-        # Prep (if needed)
-        ems_prep(runDir, chunk['spinupDate'], dset=args.dset,
-                 length=chunk['hours'], nDomains=nDomains,
-                 cycle=24-spinupHours, nudge=True,
-                 force=args.force)
+        ok, forced = chunk_stage(runDir, 'clone', clone, force=claim == 'reclaimed')
+
+        # Prep (if needed); again if cloned afresh
+        def prep(force):
+
+            # Hand prep whatever input data it needs from the cache
+            if cache:
+                needed = dset_times(args.dset, chunk['spinupDate'], chunk['hours'])
+                if args.source and queue:
+                    cache.prefetch(args.dset, needed, args.source, keep=planTimes)
+                gribDir = os.path.join(runDir, 'grib')
+                if not os.path.isdir(gribDir):
+                    os.makedirs(gribDir)
+                linked = [cache.link(args.dset, _, gribDir, name=locfil) for _ in needed]
+                logging.info('Linked %d of %d %s times into %s' % (
+                    len(filter(None, linked)), len(needed), args.dset, gribDir))
+
+            with metrics.stage('ems_prep', path=runDir, chunk=runDir) as m:
+                m['ok'] = ems_prep(runDir, chunk['spinupDate'], dset=args.dset,
+                                   length=chunk['hours'], nDomains=nDomains,
+                                   cycle=24-spinupHours, nudge=True,
+                                   force=force, metrics=metrics, timeout=prepTimeout)
+            return m['ok']
+
+        if ok:
+            ok, forced = chunk_stage(runDir, 'prep', prep, force=forced)
+
+        return runDir, ok, forced
+
+    def chunk_run(prepped):
+        """
+        Run a single prepped chunk.
+        """
+
+        runDir, ok, forced = prepped
+
+        # Run (if needed); again if prepped afresh
+        def run(force):
+            with metrics.stage('ems_run', path=runDir, chunk=runDir, hours=hours[runDir]) as m:
+                m['ok'] = ems_run(runDir, nDomains=nDomains, nudge=True, nodes=nodes,
+                                  force=force, metrics=metrics, timeout=runTimeout)
+            return m['ok']
+
+        # Slim (if asked); again if run afresh
+        def slim(force):
+            # Only needed (with netCDF4) to slim
+            import ems_dechunk
+            with metrics.stage('ems_slim', path=runDir, chunk=runDir) as m:
+                m['ok'] = all(ems_slim(runDir, wrfFile, args.slim, metrics=metrics)
+                              for wrfFile in sorted(glob.glob(os.path.join(runDir, 'wrfprd', 'wrfout*')))
+                              if force or not os.path.isfile(ems_dechunk.slim_file(wrfFile)))
+            return m['ok']
 
-        # Run (if needed)
         if args.skiprun:
             logging.info("NOT running %s; skipping" % runDir)
-        else:
-            ems_run(runDir, nDomains=nDomains, nudge=True, nodes=args.nodes,
-                    force=args.force)
+        elif ok:
+            ok, forced = chunk_stage(runDir, 'run', run, force=forced)
+            if ok and args.slim is not None:
+                ok, forced = chunk_stage(runDir, 'slim', slim, force=forced)
+
+            # Full files are no longer needed once slimmed
+            if ok and args.slim is not None and args.prune:
+                for wrfFile in sorted(glob.glob(os.path.join(runDir, 'wrfprd', 'wrfout*'))):
+                    logging.info('Removing %s' % wrfFile)
+                    os.remove(wrfFile)
+                    state.drop(runDir, 'run', wrfFile)
+
+        # Make sure nothing was written through to the master's files
+        if not ems_shared_check(runDir):
+            ok = False
+
+        # Let other workers know
+        if queue:
+            queue.release(os.path.basename(runDir), ('prep' if args.skiprun else 'run') if ok else 'redo')
+            slots.release()
+
+        return runDir, ok
+
+    # The chunks this worker is to do, and whether each was reclaimed
+    if queue:
+        slots = threading.Semaphore(args.concurrent + args.prepahead)
+        todo = queue.claims(chunks, lambda _: os.path.basename(chunk_dir(_)), slots,
+                            marks=('prep', 'run') if args.skiprun else ('run',))
+    else:
+        todo = ((chunk, False) for chunk in chunks)
 
-        # Move the sticks
-        d = chunk['endDate']
+    # Anything the background prep raised
+    errors = []
+
+    if args.prepahead > 0:
+
+        # Pipeline; prep in a background thread, never getting more than
+        # prepahead chunks ahead of those that have started running
+        ahead = threading.Semaphore(args.prepahead)
+        prepped = Queue.Queue()
+
+        def prep_stage():
+            try:
+                for claimed in todo:
+                    ahead.acquire()
+                    prepped.put(chunk_prep(claimed))
+            except BaseException:
+                # Raised in the main thread once those prepped are run
+                errors.append(sys.exc_info())
+            finally:
+                prepped.put(None)
+
+        stage = threading.Thread(target=prep_stage)
+        stage.daemon = True
+        stage.start()
+
+        def chunk_go(prepped):
+            ahead.release()
+            return chunk_run(prepped)
+
+        tasks = iter(prepped.get, None)
+
+    else:
+
+        # Clone, prep and run each chunk in turn
+        def chunk_go(claimed):
+            return chunk_run(chunk_prep(claimed))
+
+        tasks = todo
+
+    # Iteration over all chunks; as one finishes the next one starts
+    if args.concurrent > 1:
+        pool = multiprocessing.pool.ThreadPool(args.concurrent)
+        results = pool.imap_unordered(chunk_go, tasks)
+    else:
+        pool = None
+        results = itertools.imap(chunk_go, tasks)
+
+    # Report progress
+    n = 0
+    for n, (runDir, ok) in enumerate(results, 1):
+        status = 'Finished' if ok else 'FAILED'
+        logging.info('%s %s; %d of %d chunks done' % (status, runDir, n, len(chunks)))
+        print '%s %s (%d of %d)' % (status, runDir, n, len(chunks))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    state.close()
+    if cache:
+        cache.close()
+    if queue:
+        queue.close()
+
+    # Background prep gave up; the rest of the chunks were never started
+    if errors:
+        logging.error('Prepping gave up; %d of %d chunks done' % (n, len(chunks)))
+        raise errors[0][0], errors[0][1], errors[0][2]
 
 
 if __name__ == "__main__":
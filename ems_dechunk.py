@@ -3,12 +3,38 @@
 
 import os
 import glob
+import itertools
+import multiprocessing
 import argparse
+import collections
+import csv
+import re
+import json
 import datetime
 import logging
+import resource
+import time
+import shutil
+import tempfile
+import zipfile
 import numpy as np
 from netCDF4 import Dataset
 
+from ems_metrics import Metrics, metrics_file
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    # Only needed to find locations in projections without a closed form
+    cKDTree = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Only needed for Parquet output
+    pa = None
+
 
 # Establish EMS_RUN
 try:
@@ -24,6 +50,39 @@ def center(longitude):
     return ((longitude + 180.0) % 360) - 180.0
 
 
+def cartesian(latitude, longitude):
+    """
+    Return points on the unit sphere (point by x, y, z) given latitudes and
+    longitudes.
+    """
+
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+# Global attributes identifying a grid's geometry (along with its shape)
+GEOMETRY_KEY = ['MAP_PROJ', 'TRUELAT1', 'TRUELAT2', 'STAND_LON', 'DX', 'DY',
+                'CEN_LAT', 'CEN_LON', 'POLE_LAT', 'POLE_LON']
+
+# WRF projections (MAP_PROJ) with a closed form; others are searched
+PROJECTIONS = {1: 'lambert', 2: 'polar', 3: 'mercator', 6: 'latlon'}
+
+# Largest per-variable chunk cache to ask for (bytes)
+CHUNK_CACHE_MAX = 256*1024**2
+
+# Largest amount of decoded hyperslabs to keep in memory per file (bytes)
+READ_CACHE_MAX = 256*1024**2
+
+# What is calculated from the grid geometry (and can be cached)
+GEOMETRY = ['projection', 'xlat', 'xlon', 'knowni', 'knownj', 'lat1', 'lon1',
+            'hemi', 'cone', 'dlon1', 'rsw', 'polei', 'polej', 'reflon',
+            'scale_top', 'dlon', 'latinc', 'loninc', 'cos_alpha', 'sin_alpha']
+
+# Spatial indices of grids without a closed form, built once per process
+# (see WRFDataset.search)
+TREES = {}
+
+
 class WRFArray(np.ndarray):
     """
     Subclass numpy ndarray to include units attribute
@@ -38,27 +97,67 @@ class WRFArray(np.ndarray):
         self.desc = desc
 
 
+class WRFVariable(object):
+    """
+    Lazy view of a WRF variable; nothing is read until sliced, and then
+    through the dataset's read cache (see WRFDataset.read).
+    """
+
+    def __init__(self, dataset, n):
+        self.dataset = dataset
+        self.v, self.units, self.desc = dataset.lookup(n)
+        self.name = n
+        self.dimensions = self.v.dimensions
+        self.shape = self.v.shape
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),)*(len(self.shape)-len(index))
+        return WRFArray(self.dataset.read(self.v, index), units=self.units, desc=self.desc)
+
+
 class WRFDataset(object):
 
     """
     Class for conversion of geographical latitude and longitude values to
-    the cartesian x, y on a Lambert Conformal projection.
-    Adapted from Fortran subroutine llij_lc in read_wrf_nc.f
+    the cartesian x, y on a Lambert Conformal, polar stereographic,
+    Mercator, or regular latitude-longitude projection.
+    Adapted from Fortran subroutines llij_lc, llij_ps, and llij_merc in
+    read_wrf_nc.f and WRF's module_map_utils
     http://www2.mmm.ucar.edu/wrf/src/read_wrf_nc.f
-    Todo:  Move projection stuff into a separate class to allow other
-    projections...
+    Other grids (e.g. rotated latitude-longitude) are searched instead.
     """
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, cache=None, memory=READ_CACHE_MAX):
+        """
+        Open WRF netCDF file_name, or rather its slim companion if there is
+        one (see slim).
+        If cache (an .npz file name) is supplied, the grid geometry is read
+        from there, provided it matches this file's projection and grid, and
+        is otherwise calculated and saved there for next time.
+        Up to memory bytes of what is read is kept for re-use (see read),
+        and no more is read at once around points (see extract_points).
+        """
 
-        # Open netcdf file
-        self.f = Dataset(file_name)
+        # Open netcdf file; its slim companion (see slim) in preference, with
+        # anything that lacks from the full file (if still around)
+        self.full = None
+        if os.path.isfile(slim_file(file_name)):
+            if os.path.isfile(file_name):
+                self.full = Dataset(file_name)
+            self.f = Dataset(slim_file(file_name))
+        else:
+            self.f = Dataset(file_name)
 
         # Title
         self.title = getattr(self.f, 'TITLE').strip()
 
         # Variables
         self.v = self.f.variables
+        if self.full is not None:
+            self.v = collections.OrderedDict(self.full.variables)
+            self.v.update(self.f.variables)
 
         # Start time for sim
         self.start_date = datetime.datetime.strptime(
@@ -66,13 +165,16 @@ class WRFDataset(object):
                             '%Y-%m-%d_%H:%M:%S')
 
         # Sims times
+        xtime = np.rint(self.v['XTIME'][:])
         self.times = [ self.start_date + datetime.timedelta(hours=_/60.0)
-            for _ in np.rint(self.v['XTIME'][:]) ]
+            for _ in xtime ]
 
-        # Check Projection
-        if getattr(self.f, 'MAP_PROJ') != 1:
-            logging.error('Expecting Lambert Conformal project')
-            raise SystemExit
+        # ... and as an array
+        self.times64 = np.datetime64(self.start_date, 's') + \
+            np.asarray(xtime).astype('int64').astype('timedelta64[m]')
+
+        # Projection
+        self.map_proj = getattr(self.f, 'MAP_PROJ')
 
         # WRF mean radius of earth (m)
         self.re = 6370000.0
@@ -84,19 +186,79 @@ class WRFDataset(object):
         self.dx = getattr(self.f, 'DX')
         self.dy = getattr(self.f, 'DY')
 
+        # Shape ni, nj
+        self.ni = len(self.f.dimensions['south_north'])
+        self.nj = len(self.f.dimensions['west_east'])
+
+        # Storage chunking of variables (see chunks)
+        self.chunking = {}
+
+        # Tally of reads; number of reads, bytes of (decompressed) storage
+        # chunks touched, bytes read, bytes returned, and seconds spent
+        # reading; as well as hits and misses of the read cache
+        self.stats = {'reads': 0, 'touched': 0, 'read': 0, 'returned': 0,
+                      'seconds': 0.0, 'hits': 0, 'misses': 0}
+
+        # Decoded hyperslabs, least recently used first
+        self.memory = memory
+        self.cache = collections.OrderedDict()
+        self.cached = 0
+
+        # Grid geometry; all chunks of a domain share the same grid
+        if cache is None or not self.load_geometry(cache):
+            self.geometry()
+            if cache is not None:
+                self.save_geometry(cache)
+
+    def geometry(self):
+        """
+        Calculate the grid geometry i.e. latitudes, longitudes, projection
+        constants and grid rotation.
+        """
+
         # Latitude and longitude
         self.xlat = self.v['XLAT'][0]
         self.xlon = self.v['XLONG'][0]
 
-        # Shape ni, nj
-        self.ni, self.nj = self.xlat.shape[-2], self.xlat.shape[-1]
-
         # Southwest corner coordinates
         self.knowni = 1
         self.knownj = 1
         self.lat1 = self.xlat[0,0]
         self.lon1 = self.xlon[0,0]
 
+        self.projection = PROJECTIONS.get(self.map_proj, 'search')
+
+        if self.projection == 'lambert':
+            self.geometry_lambert()
+        elif self.projection == 'polar':
+            self.geometry_polar()
+        elif self.projection == 'mercator':
+            self.geometry_mercator()
+        elif self.projection == 'latlon':
+            self.geometry_latlon()
+
+        # Rotation of grid at every grid point
+        if self.projection in ('lambert', 'polar'):
+            a = self.alpha(self.xlat, self.xlon)
+            self.cos_alpha = np.cos(np.radians(a))
+            self.sin_alpha = np.sin(np.radians(a))
+        elif self.projection == 'search' and 'COSALPHA' in self.v:
+            # WRF's own, which rotates the other way
+            self.cos_alpha = self.v['COSALPHA'][0]
+            self.sin_alpha = -self.v['SINALPHA'][0]
+        else:
+            self.cos_alpha = np.ones_like(self.xlat)
+            self.sin_alpha = np.zeros_like(self.xlat)
+
+        if self.projection == 'search':
+            logging.info('No closed form for MAP_PROJ %s; searching grid for locations' %
+                         self.map_proj)
+
+    def geometry_lambert(self):
+        """
+        Lambert Conformal projection constants; see set_lc.
+        """
+
         # Calc hemisphere factor
         self.hemi = np.sign(self.truelat1)
 
@@ -119,6 +281,98 @@ class WRFDataset(object):
         self.polei = self.hemi*self.knowni - self.hemi*self.rsw*np.sin(self.cone*np.radians(self.dlon1))
         self.polej = self.hemi*self.knownj + self.rsw*np.cos(self.cone*np.radians(self.dlon1))
 
+    def geometry_polar(self):
+        """
+        Polar stereographic projection constants; see set_ps.
+        """
+
+        self.hemi = 1.0 if self.truelat1 >= 0 else -1.0
+        self.cone = 1.0
+        self.reflon = self.stand_lon + 90.0
+
+        # Numerator of map scale factor
+        self.scale_top = 1.0 + self.hemi*np.sin(np.radians(self.truelat1))
+
+        # Radius to southwest corner
+        self.rsw = self.re/self.dx*np.cos(np.radians(self.lat1))*self.scale_top / \
+                (1.0 + self.hemi*np.sin(np.radians(self.lat1)))
+
+        # Find pole point
+        self.polei = self.knowni - self.rsw*np.cos(np.radians(self.lon1-self.reflon))
+        self.polej = self.knownj - self.hemi*self.rsw*np.sin(np.radians(self.lon1-self.reflon))
+
+    def geometry_mercator(self):
+        """
+        Mercator projection constants; see set_merc.
+        """
+
+        # Longitude increment (radians) of grid
+        self.dlon = self.dx/(self.re*np.cos(np.radians(self.truelat1)))
+
+        # Distance to equator from southwest corner
+        self.rsw = np.log(np.tan(0.5*np.radians(self.lat1+90.0)))/self.dlon
+
+    def geometry_latlon(self):
+        """
+        Regular latitude-longitude grid increments; found from the grid
+        itself, which is searched instead if it turns out to be irregular
+        (e.g. rotated).
+        """
+
+        self.latinc = (self.xlat[-1,0]-self.xlat[0,0])/max(self.ni-1, 1)
+        self.loninc = center(self.xlon[0,-1]-self.xlon[0,0])/max(self.nj-1, 1)
+
+        i, j = np.mgrid[0:self.ni, 0:self.nj]
+        if not (np.allclose(self.xlat, self.lat1 + i*self.latinc, atol=1e-3) and
+                np.allclose(center(self.xlon - self.lon1 - j*self.loninc), 0, atol=1e-3)):
+            self.projection = 'search'
+
+    def geometry_key(self):
+        """
+        Return what identifies the grid geometry i.e. projection and grid.
+        """
+        return np.array([getattr(self.f, _, 0) for _ in GEOMETRY_KEY] + [self.ni, self.nj],
+                        dtype=np.float64)
+
+    def load_geometry(self, cache):
+        """
+        Load grid geometry from cache file, if it matches.
+        Returns True if successful.
+        """
+
+        try:
+            with np.load(cache) as g:
+                if not np.array_equal(g['key'], self.geometry_key()):
+                    logging.info('Grid geometry in %s does not match; recalculating' % cache)
+                    return False
+                for n in GEOMETRY:
+                    if n not in g.files:
+                        continue
+                    g_n = g[n]
+                    setattr(self, n, g_n[()] if g_n.ndim == 0 else g_n)
+        except (IOError, KeyError):
+            return False
+
+        return True
+
+    def save_geometry(self, cache):
+        """
+        Save grid geometry to cache file.
+        Written alongside and swapped in so simultaneous readers never see
+        a partial file.
+        """
+
+        try:
+            tmp = '%s.%d' % (cache, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.savez(f, key=self.geometry_key(),
+                         **dict((n, np.asarray(getattr(self, n))) for n in GEOMETRY
+                                if hasattr(self, n)))
+            os.rename(tmp, cache)
+            logging.info('Cached grid geometry in %s' % cache)
+        except (IOError, OSError) as e:
+            logging.warning('Could not cache grid geometry in %s: %s' % (cache, e))
+
     def __repr__(self):
         """
         Just copy Dataset's repr
@@ -143,6 +397,16 @@ class WRFDataset(object):
         Safely close netcdf file.
         """
         self.f.close()
+        if self.full is not None:
+            self.full.close()
+        self.cache.clear()
+        self.cached = 0
+
+    def __getitem__(self, n):
+        """
+        Lazy view of variable n (see WRFVariable).
+        """
+        return WRFVariable(self, n)
 
     def ij2ll(self, i, j):
         """
@@ -150,33 +414,179 @@ class WRFDataset(object):
         """
         return self.xlat[i, j], self.xlon[i, j]
 
-    def ll2ij(self, lat, lon):
+    def ll2ij(self, lat, lon, exact=False):
         """
         Return location in grid given latitude, longitude.
+        If exact, return the fractional location rather than the nearest.
         """
 
-        # Radius to desired point
-        rm = self.re/self.dx * np.cos(np.radians(self.truelat1)) / self.cone * \
-                (np.tan(np.radians(90.0*self.hemi-lat)*0.5) /
-                    np.tan(np.radians(90.0*self.hemi-self.truelat1)*0.5))**self.cone
+        if self.projection == 'lambert':
+
+            # Radius to desired point
+            rm = self.re/self.dx * np.cos(np.radians(self.truelat1)) / self.cone * \
+                    (np.tan(np.radians(90.0*self.hemi-lat)*0.5) /
+                        np.tan(np.radians(90.0*self.hemi-self.truelat1)*0.5))**self.cone
+
+            # Transformation
+            dlon = center(lon - self.stand_lon)
+
+            x = self.polei + self.hemi*rm*np.sin(self.cone*np.radians(dlon))
+            y = self.polej - rm*np.cos(self.cone*np.radians(dlon))
+
+            # Correct for hemisphere (hopefully)
+            x, y = self.hemi*x, self.hemi*y
 
-        # Transformation
-        dlon = center(lon - self.stand_lon)
+        elif self.projection == 'polar':
 
-        x = self.polei + self.hemi*rm*np.sin(self.cone*np.radians(dlon))
-        y = self.polej - rm*np.cos(self.cone*np.radians(dlon))
+            # Radius to desired point
+            rm = self.re/self.dx*np.cos(np.radians(lat))*self.scale_top / \
+                    (1.0 + self.hemi*np.sin(np.radians(lat)))
+
+            x = self.polei + rm*np.cos(np.radians(lon-self.reflon))
+            y = self.polej + self.hemi*rm*np.sin(np.radians(lon-self.reflon))
+
+        elif self.projection == 'mercator':
+
+            x = self.knowni + np.radians(center(lon-self.lon1))/self.dlon
+            y = self.knownj + np.log(np.tan(0.5*np.radians(lat+90.0)))/self.dlon - self.rsw
+
+        elif self.projection == 'latlon':
+
+            x = self.knowni + center(lon-self.lon1)/self.loninc
+            y = self.knownj + (lat-self.lat1)/self.latinc
+
+        else:
+            return self.search(lat, lon, exact=exact)
+
+        # Return fractional, if asked (as below)
+        if exact:
+            return y-1, x-1
 
         # Return integer
-        # ... and correcting for hemisphere (hopefully)
         # ... and switch to zero-indexing
-        return np.rint(self.hemi*y).astype(int)-1, np.rint(self.hemi*x).astype(int)-1
+        return np.rint(y).astype(int)-1, np.rint(x).astype(int)-1
+
+    def search(self, lat, lon, exact=False):
+        """
+        Return location in grid given latitude, longitude by searching for the
+        nearest grid point in a KD-tree of the grid's points on the unit
+        sphere; for grids without a closed form.  The tree is built once (per
+        process) for each grid.
+        If exact, return the fractional location, found from the local
+        gradients of latitude and longitude in the grid.
+        Locations further than a grid cell's diagonal from any grid point are
+        outside the grid (-1, -1).
+        """
+
+        if cKDTree is None:
+            print 'ERROR:  scipy is needed to find locations in MAP_PROJ %s grids' % self.map_proj
+            raise SystemExit
+
+        key = self.geometry_key().tostring()
+        if key not in TREES:
+            TREES[key] = cKDTree(cartesian(self.xlat.ravel(), self.xlon.ravel()))
+
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        d, n = TREES[key].query(cartesian(lat.ravel(), lon.ravel()))
+        i, j = np.unravel_index(n, self.xlat.shape)
+
+        # Too far away
+        outside = d > np.hypot(self.dx, self.dy)/self.re
+
+        if exact:
+
+            # Gradients of latitude and (eastward distance in) longitude
+            # with grid index, centred where possible
+            ip, im = np.minimum(i+1, self.ni-1), np.maximum(i-1, 0)
+            jp, jm = np.minimum(j+1, self.nj-1), np.maximum(j-1, 0)
+            coslat = np.cos(np.radians(self.xlat[i, j]))
+            J = np.empty(i.shape + (2, 2))
+            J[:, 0, 0] = (self.xlat[ip, j]-self.xlat[im, j])/(ip-im)
+            J[:, 0, 1] = (self.xlat[i, jp]-self.xlat[i, jm])/(jp-jm)
+            J[:, 1, 0] = center(self.xlon[ip, j]-self.xlon[im, j])*coslat/(ip-im)
+            J[:, 1, 1] = center(self.xlon[i, jp]-self.xlon[i, jm])*coslat/(jp-jm)
+
+            b = np.stack([lat.ravel()-self.xlat[i, j],
+                          center(lon.ravel()-self.xlon[i, j])*coslat], axis=-1)
+            di, dj = np.linalg.solve(J, b[..., None])[..., 0].T
+
+            fi, fj = i+di, j+dj
+            fi[outside], fj[outside] = -1, -1
+            return fi.reshape(lat.shape), fj.reshape(lat.shape)
+
+        i[outside], j[outside] = -1, -1
+        return i.reshape(lat.shape), j.reshape(lat.shape)
+
+    def stencil(self, i, j, method='bilinear', power=2):
+        """
+        Given fractional locations i, j (arrays) in grid, return the indices
+        and weights of the four surrounding grid points for interpolation.
+        method is bilinear or idw (inverse distance weighting to the power).
+        Returns a dictionary keyed by horizontal dimensions, one for each of
+        the mass, U and V (staggered) grids, of (i, j, weights) each shaped
+        point by 4.  Compute once; use with extract_stencil.
+        """
+
+        i, j = np.atleast_1d(i), np.atleast_1d(j)
+
+        stencil = {}
+        for di, dj, dims in [(0.0, 0.0, (u'south_north', u'west_east')),
+                             (0.0, 0.5, (u'south_north', u'west_east_stag')),
+                             (0.5, 0.0, (u'south_north_stag', u'west_east'))]:
+
+            # Staggered grids are offset by half a cell (and have one more)
+            fi, fj = i+di, j+dj
+            ni, nj = self.ni+int(2*di), self.nj+int(2*dj)
+
+            # Southwest corner of surrounding cell; stay on grid
+            i0 = np.clip(np.floor(fi).astype(int), 0, ni-2)
+            j0 = np.clip(np.floor(fj).astype(int), 0, nj-2)
+
+            # Corners SW, SE, NW, NE
+            ci = i0[:, None] + np.array([0, 0, 1, 1])
+            cj = j0[:, None] + np.array([0, 1, 0, 1])
+
+            if method == 'bilinear':
+                wi = np.clip(fi-i0, 0, 1)[:, None]
+                wj = np.clip(fj-j0, 0, 1)[:, None]
+                w = np.where(ci > i0[:, None], wi, 1-wi)*np.where(cj > j0[:, None], wj, 1-wj)
+
+            elif method == 'idw':
+                d = np.hypot(ci-fi[:, None], cj-fj[:, None])
+                with np.errstate(divide='ignore'):
+                    w = 1.0/d**power
+                # Right on top of a grid point
+                hit = d == 0
+                w[np.any(hit, axis=1)] = hit[np.any(hit, axis=1)]
+                w /= np.sum(w, axis=1)[:, None]
+
+            else:
+                print 'Do not understand', method, 'interpolation, sorry...'
+                raise SystemExit
+
+            stencil[dims] = (ci, cj, w)
+
+        return stencil
 
     def alpha(self, lat, lon):
         """
         Angle that positive geographical (eastward) x-axis is away from
-        positive Lambert x-axis.
+        positive grid x-axis.
         """
-        return np.sign(lat)*center(lon-self.stand_lon)*self.cone
+
+        if self.projection == 'lambert':
+            return np.sign(lat)*center(lon-self.stand_lon)*self.cone
+
+        elif self.projection == 'polar':
+            return self.hemi*center(lon-self.stand_lon)
+
+        elif self.projection in ('mercator', 'latlon'):
+            return np.zeros_like(np.asarray(lat, dtype=float))
+
+        # That of the nearest grid point
+        i, j = self.search(lat, lon)
+        i, j = np.clip(i, 0, self.ni-1), np.clip(j, 0, self.nj-1)
+        return np.degrees(np.arctan2(self.sin_alpha[i, j], self.cos_alpha[i, j]))
 
     def rotate(self, u, v, lat, lon):
         """
@@ -189,15 +599,10 @@ class WRFDataset(object):
         sin_alpha = np.sin(np.radians(a))
         return v*sin_alpha+u*cos_alpha, v*cos_alpha-u*sin_alpha
 
-    def extract(self, n, t=slice(None),
-                        i=slice(None), j=slice(None), k=slice(None),
-                        s=slice(None), c=slice(None)):
+    def lookup(self, n):
         """
-        Given variable name n will return a sliced array (and units!).
-        t is time, i is south_north, j is west_east, k is bottom_top,
-        s is soil_layers, and c is land_cat.
-        Defaults are everything i.e. slice(None).
-        Can pass intervals as well e.g. i=slice(3,10).
+        Given variable name n will return the netCDF variable, its units and
+        its description.
         """
 
         # Check that key exists
@@ -221,285 +626,2054 @@ class WRFDataset(object):
         except AttributeError:
             desc = n
 
+        return v, units, desc
+
+    def chunks(self, v):
+        """
+        Return the storage chunk shape of netCDF variable v; the whole
+        variable if it is not chunked.
+        The first time round, the variable's chunk cache is also enlarged to
+        hold a whole horizontal layer of chunks (within reason) so that
+        repeated reads do not decompress the same chunks over and over.
+        """
+
+        try:
+            return self.chunking[v.name]
+        except KeyError:
+            pass
+
+        chunking = v.chunking()
+        if chunking in (None, 'contiguous'):
+            chunking = list(v.shape)
+        else:
+            size, nelems, preemption = v.get_var_chunk_cache()
+            layer = np.prod([int(np.ceil(float(n)/c)) for n, c in zip(v.shape[-2:], chunking[-2:])])
+            want = min(layer*np.prod(chunking)*v.dtype.itemsize, CHUNK_CACHE_MAX)
+            if want > size:
+                v.set_var_chunk_cache(size=want, nelems=max(nelems, 2*layer+1),
+                                      preemption=preemption)
+
+        self.chunking[v.name] = [max(1, _) for _ in chunking]
+        return self.chunking[v.name]
+
+    def read(self, v, index, points=None):
+        """
+        Read hyperslab index (a tuple, one per dimension) of netCDF variable v,
+        keeping tally of bytes read in stats.
+        Hyperslabs are served from memory if they (or any hyperslab holding
+        them) have already been read; see recall.
+        If points (a tuple of i, j arrays) is supplied, only those points of
+        the last two dimensions are returned.
+        """
+
+        a = self.recall(v, index)
+        if a is None:
+            a = self.read_disk(v, index)
+        else:
+            self.stats['hits'] += 1
+
+        if points is not None:
+            a = np.asarray(a)[..., points[0], points[1]]
+        else:
+            # Cached hyperslabs must not be modified by caller
+            a = a.copy()
+
+        self.stats['returned'] += np.asarray(a).nbytes
+
+        return a
+
+    def box(self, v, index):
+        """
+        Return hyperslab index of netCDF variable v as a tuple of (lo, hi)
+        bounds, one per dimension, or None if it is not a simple box (e.g.
+        strided or fancy indexing).
+        """
+
+        box = []
+        for x, n in zip(index, v.shape):
+            if isinstance(x, slice):
+                lo, hi, step = x.indices(n)
+                if step != 1:
+                    return None
+                box.append((lo, max(lo, hi)))
+            elif np.ndim(x) == 0 and not isinstance(x, np.ndarray):
+                lo = int(x) % n
+                box.append((lo, lo+1))
+            else:
+                return None
+        return tuple(box)
+
+    def recall(self, v, index):
+        """
+        Return hyperslab index of netCDF variable v from the read cache, if
+        it or any hyperslab holding it has been read; otherwise None.
+        """
+
+        box = self.box(v, index)
+        if box is None:
+            return None
+
+        for key in reversed(self.cache):
+            name, held = key
+            if name != v.name or \
+                    not all(h[0] <= b[0] and b[1] <= h[1] for b, h in zip(box, held)):
+                continue
+
+            # Most recently used goes last
+            a = self.cache.pop(key)
+            self.cache[key] = a
+
+            within = tuple(slice(b[0]-h[0], b[1]-h[0]) if isinstance(x, slice) else b[0]-h[0]
+                           for x, b, h in zip(index, box, held))
+            return a[within]
+
+        return None
+
+    def read_disk(self, v, index):
+        """
+        Read hyperslab index of netCDF variable v from file, keeping it in the
+        read cache (if it is a simple box) within the memory allowed, and
+        tallying up what was read.
+        """
+
+        t0 = time.time()
+
+        box = self.box(v, index)
+        if box is None:
+            a = v[index]
+        else:
+            self.stats['misses'] += 1
+
+            # Keep all dimensions in cache; drop integer ones on return
+            a = v[tuple(slice(*_) for _ in box)]
+            size = np.asarray(a).nbytes
+            if size <= self.memory:
+                self.cache[(v.name, box)] = a
+                self.cached += size
+                while self.cached > self.memory:
+                    key, old = self.cache.popitem(last=False)
+                    self.cached -= np.asarray(old).nbytes
+            a = a[tuple(slice(None) if isinstance(x, slice) else 0 for x in index)]
+
+        # Tally up decompressed chunks touched, hyperslab read, and returned
+        chunking = self.chunks(v)
+        touched = np.dtype(v.dtype).itemsize
+        for x, n, c in zip(index, v.shape, chunking):
+            if isinstance(x, slice):
+                lo, hi, step = x.indices(n)
+                hi = max(lo, hi)
+            elif np.ndim(x) == 0:
+                lo = x % n
+                hi = lo+1
+            else:
+                lo, hi = np.min(x) % n, np.max(x) % n + 1
+            touched *= (int(np.ceil(float(hi)/c)) - lo//c)*c
+
+        self.stats['reads'] += 1
+        self.stats['touched'] += touched
+        self.stats['read'] += np.asarray(a).nbytes
+        self.stats['seconds'] += time.time()-t0
+
+        return a
+
+    def rotate_ij(self, u, v, i, j):
+        """
+        Rotate Lambert vector onto geographic coordinates
+        (u=east/west, v=north/south) at grid location i, j.
+        Uses the precalculated rotation of the grid.
+        """
+
+        cos_alpha = self.cos_alpha[i, j]
+        sin_alpha = self.sin_alpha[i, j]
+        return v*sin_alpha+u*cos_alpha, v*cos_alpha-u*sin_alpha
+
+    def extract(self, n, t=slice(None),
+                        i=slice(None), j=slice(None), k=slice(None),
+                        s=slice(None), c=slice(None)):
+        """
+        Given variable name n will return a sliced array (and units!).
+        t is time, i is south_north, j is west_east, k is bottom_top,
+        s is soil_layers, and c is land_cat.
+        Defaults are everything i.e. slice(None).
+        Can pass intervals as well e.g. i=slice(3,10).
+        """
+
+        v, units, desc = self.lookup(n)
+
         # Switch our extraction call based on dimensions of named variable
         d = v.dimensions
 
         if d == (u'Time', u'south_north', u'west_east'):
             # Surface, e.g. T2
-            return WRFArray(np.squeeze(v[t, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'bottom_top', u'south_north', u'west_east_stag'):
             # 3D, U-like
-            return WRFArray(np.squeeze(v[t, k, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, k, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'bottom_top', u'south_north_stag', u'west_east'):
             # 3D, V-like
-            return WRFArray(np.squeeze(v[t, k, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, k, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'bottom_top_stag', u'south_north', u'west_east'):
             # 3D, W-like
-            return WRFArray(np.squeeze(v[t, k, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, k, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'bottom_top', u'south_north', u'west_east'):
             # 3D, centered, non-staggered, e.g. TKE
-            return WRFArray(np.squeeze(v[t, k, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, k, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'soil_layers_stag', u'south_north', u'west_east'):
             # 3D-ish, soil layers, surface
-            return WRFArray(np.squeeze(v[t, s, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, s, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'bottom_top'):
             # Time, centered vertical, e.g. ZNU {eta values on half (mass) levels}
-            return WRFArray(np.squeeze(v[t, k]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, k))), units=units, desc=desc)
 
         elif d == (u'Time', u'bottom_top_stag'):
             # time, staggered vertical, e.g. ZNW {eta values on full (W) levels}
-            return WRFArray(np.squeeze(v[t, k]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, k))), units=units, desc=desc)
 
         elif d == (u'Time', u'soil_layers_stag'):
             # time, soil layers, e.g. ZS {soil layer depths}
-            return WRFArray(np.squeeze(v[t, s]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, s))), units=units, desc=desc)
 
         elif d == (u'Time', u'south_north_stag', u'west_east'):
             # time, staggered north
-            return WRFArray(np.squeeze(v[t, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, i, j))), units=units, desc=desc)
 
         elif d == (u'Time', u'south_north', u'west_east_stag'):
             # time, staggered east
-            return WRFArray(np.squeeze(v[t, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, i, j))), units=units, desc=desc)
 
         elif d == (u'Time',):
             # just boring ol' time
-            return WRFArray(np.squeeze(v[t]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t,))), units=units, desc=desc)
 
         elif d == (u'Time', u'land_cat_stag', u'south_north', u'west_east'):
             # land use e.g. LANDUSEF (landuse fraction by category)
-            return WRFArray(np.squeeze(v[t, c, i, j]), units=units, desc=desc)
+            return WRFArray(np.squeeze(self.read(v, (t, c, i, j))), units=units, desc=desc)
 
         else:
             print 'Do not understand', d, 'dimensions, sorry...'
             raise SystemExit
 
-def main():
+    def extract_points(self, n, i, j, t=slice(None), k=slice(None)):
+        """
+        Given variable name n and arrays of grid indices i, j will return a
+        time by point array (and units!) for all points at once.
+        The variable is read as a single block spanning all points rather than
+        point by point (a few levels at a time, should that be more than
+        memory); handy when pulling out many sites.
+        t is time and k is bottom_top (or bottom_top_stag); 3D variables
+        return time by level by point unless k is an integer.
+        """
 
+        v, units, desc = self.lookup(n)
 
-    """
-    Read and form time series from a series of WRF EMS runs.
-    """
+        # Only fields on the (possibly staggered) horizontal grid make sense
+        d = v.dimensions
+        if len(d) not in (3, 4) or d[0] != u'Time' or \
+                d[-2] not in (u'south_north', u'south_north_stag') or \
+                d[-1] not in (u'west_east', u'west_east_stag'):
+            print 'Do not understand', d, 'dimensions, sorry...'
+            raise SystemExit
 
-    parser = argparse.ArgumentParser(
-        description=main.__doc__,
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
+        i, j = np.atleast_1d(i), np.atleast_1d(j)
+        lead = (t,) if len(d) == 3 else (t, k)
+
+        # Storage chunks (tiles) of the horizontal grid holding points
+        ci, cj = self.chunks(v)[-2:]
+        ti, tj = i//ci, j//cj
+        tiles = sorted(set(zip(ti, tj)))
+
+        # Bounding block of all points
+        i0, i1 = i.min(), i.max()+1
+        j0, j1 = j.min(), j.max()+1
+        nTiles = (ti.max()-ti.min()+1)*(tj.max()-tj.min()+1)
+
+        # Read (and decompress) only the tiles with points, if that saves any
+        if len(tiles) < nTiles:
+            a = None
+            for tile in tiles:
+                p = (ti == tile[0]) & (tj == tile[1])
+                ti0, tj0 = tile[0]*ci, tile[1]*cj
+                block = self.read(v, lead + (slice(ti0, ti0+ci), slice(tj0, tj0+cj)),
+                                  points=(i[p]-ti0, j[p]-tj0))
+                if a is None:
+                    a = np.empty(block.shape[:-1] + i.shape, dtype=block.dtype)
+                a[..., p] = block
+        else:
+            a = None
+            for piece, within in self.pieces(v, lead, (i1-i0)*(j1-j0)):
+                block = self.read(v, piece + (slice(i0, i1), slice(j0, j1)), points=(i-i0, j-j0))
+                if a is None:
+                    a = np.empty(self.shape(v, lead) + i.shape, dtype=block.dtype)
+                a[within] = block
 
-    parser.add_argument('domain', help='specify root domain')
+        return WRFArray(a, units=units, desc=desc)
 
-    parser_location = parser.add_mutually_exclusive_group(required=True)
+    def shape(self, v, lead):
+        """
+        Return the shape of leading index lead (time, and level if any) of
+        netCDF variable v; integers are dropped.
+        """
+        return tuple(len(range(*x.indices(n))) for x, n in zip(lead, v.shape)
+                     if isinstance(x, slice))
 
-    parser_location.add_argument('-ll', dest='ll', metavar=('lat', 'lon'), nargs=2,
-        type=float, help='specify lat lon of desired location')
+    def pieces(self, v, lead, area):
+        """
+        Split leading index lead (time, and level if any) of netCDF variable
+        v into pieces that, over area horizontal grid points, are each no
+        more than memory bytes; a few levels at a time and, should a level
+        be too much, a few times of it at a time.
+        Returns a list of (piece, within), piece indexing v and within where
+        it goes in what lead does.
+        """
 
-    parser_location.add_argument('-ij', dest='ij', metavar=('i', 'j'), nargs=2,
-        type=int, help='specify i and j index of desired location')
+        size = area*np.dtype(v.dtype).itemsize
+        ranges = [range(*x.indices(n)) if isinstance(x, slice) else None
+                  for x, n in zip(lead, v.shape)]
+
+        # How many of each (sliced) leading dimension to take at once; from
+        # the innermost (levels) out
+        steps = [len(r) if r is not None else 1 for r in ranges]
+        for d in reversed(range(len(ranges))):
+            if ranges[d] is None or lead[d].indices(v.shape[d])[2] != 1:
+                continue
+            whole = size*np.prod(steps)
+            if whole <= self.memory:
+                break
+            steps[d] = max(1, int(len(ranges[d])*self.memory // whole))
+
+        # Every combination of steps, and where each goes
+        spans = []
+        for d, r in enumerate(ranges):
+            if r is None:
+                spans.append([(lead[d], None)])
+            elif steps[d] == len(r):
+                spans.append([(lead[d], slice(None))])
+            else:
+                spans.append([(slice(r[o], r[min(o+steps[d], len(r))-1]+1), slice(o, o+steps[d]))
+                              for o in range(0, len(r), steps[d])])
 
-    parser.add_argument('-n', '--nest', metavar='int',  type=int,
-        help='specify nested domain; will use finest grid available if not supplied')
+        return [(tuple(_[0] for _ in span), tuple(_[1] for _ in span if _[1] is not None))
+                for span in itertools.product(*spans)]
 
-    parser.add_argument('--spinup', dest='spinup', metavar='hours', default=12,
-        type=int, help='specify spin-up time in hours')
 
-    args = parser.parse_args()
+    def extract_stencil(self, n, stencil, t=slice(None), k=slice(None)):
+        """
+        Given variable name n and a stencil (see stencil) will return a time by
+        point array (and units!) interpolated to the stencil's points.
+        The appropriate (staggered) grid is chosen based on the variable's
+        dimensions; the weights are applied across all times at once.
+        t is time and k is bottom_top (or bottom_top_stag).
+        """
 
-    # Point logging to domain.log
-    logging.basicConfig(filename='%s.log' % args.domain, level=logging.INFO,
-        format='%(asctime)s - %(message)s')
+        v, units, desc = self.lookup(n)
 
-    # Master directory
-    domainDir = os.path.join(EMS_RUN, args.domain)
+        try:
+            i, j, w = stencil[v.dimensions[-2:]]
+        except KeyError:
+            print 'Do not understand', v.dimensions, 'dimensions, sorry...'
+            raise SystemExit
 
-    # Check to see that we have a master root domain directory
-    if not os.path.isdir(domainDir):
-        print 'ERROR:  Make sure %s exists' % args.domain
-        raise SystemExit
+        # Pull out all four corners of all points at once; weigh and sum
+        a = self.extract_points(n, i.ravel(), j.ravel(), t=t, k=k)
+        a = np.asarray(a).reshape(a.shape[:-1] + i.shape)
 
-    # Figure out the number of domains
-    geo = glob.glob('%s/static/geo*.nc' % domainDir)
-    nDomains = len(geo)
+        return WRFArray(np.sum(a*w, axis=-1).astype(a.dtype), units=units, desc=desc)
 
-    # Determine which domain to extract
-    if args.nest:
-        nest = args.nest
-        # Check if requested nest exists
-        if nest > nDomains:
-            print 'ERROR: Requested nest %d not available.' % nest
-            raise SystemExit
-    else:
-        # Choose finest domain
-        nest = nDomains
 
-    # Figure out our simulation directories
-    runDirs = sorted([_ for _ in glob.glob('%s_%s' % (domainDir, '[0-9]'*8)) if os.path.isdir(_)])
+    def level_heights(self, i, j, stencil=None):
+        """
+        Return time by level by point heights (m above ground) of the mass
+        (half) levels at grid indices i, j (arrays), or the stencil's points
+        (see stencil), from geopotential PH+PHB of the full levels and
+        terrain HGT.
+        """
 
-    # Print header
-    header = True
+        get = self.point_reader(i, j, stencil)
 
-    # Loop over all chunks
-    for runDir in runDirs:
+        z = (get('PH') + get('PHB'))/9.81 - get('HGT')[:, None]
+        return 0.5*(z[:, :-1] + z[:, 1:])
 
-        print 'De-chunking', runDir
+    def point_reader(self, i, j, stencil=None):
+        """
+        Return a function reading a variable (by name) at grid indices i, j,
+        or interpolated to the stencil's points.
+        """
 
-        # Check if it has been run
-        wrfFiles = sorted(glob.glob(os.path.join(runDir, 'wrfprd', 'wrfout_d%02d*' % nest)))
-        if not wrfFiles:
-            logging.warning('Not extracting %s; no netCDF files; skipping' % runDir)
-            continue
+        if stencil:
+            return lambda n: np.asarray(self.extract_stencil(n, stencil))
+        else:
+            return lambda n: np.asarray(self.extract_points(n, i, j))
+
+    def destagger(self, n, i, j, stencil=None):
+        """
+        Return time by level by point array of 3D variable name n at the mass
+        points and (half) levels at grid indices i, j (arrays), or the
+        stencil's points, averaging neighbours of staggered dimensions.
+        """
+
+        v, units, desc = self.lookup(n)
+        d = v.dimensions
+
+        # A stencil already interpolates to the point on the staggered grid
+        if stencil:
+            a = np.asarray(self.extract_stencil(n, stencil))
+        elif d[-1] == u'west_east_stag':
+            a = 0.5*(np.asarray(self.extract_points(n, i, j)) +
+                     np.asarray(self.extract_points(n, i, j+1)))
+        elif d[-2] == u'south_north_stag':
+            a = 0.5*(np.asarray(self.extract_points(n, i, j)) +
+                     np.asarray(self.extract_points(n, i+1, j)))
+        else:
+            a = np.asarray(self.extract_points(n, i, j))
+
+        if d[1] == u'bottom_top_stag':
+            a = 0.5*(a[:, :-1] + a[:, 1:])
+
+        return a
+
+    def extract_heights(self, n, heights, i, j, stencil=None):
+        """
+        Given 3D variable name n and a list of heights (m above ground), will
+        return a time by height by point array (and units!) at grid indices
+        i, j (arrays), or interpolated to the stencil's points.
+        Staggered variables (e.g. U, V, W) are first destaggered onto the mass
+        levels, which are then interpolated linearly in height, for all times
+        and points at once.
+        """
+
+        v, units, desc = self.lookup(n)
+
+        if len(v.dimensions) != 4:
+            print 'Do not understand', v.dimensions, 'dimensions, sorry...'
+            raise SystemExit
+
+        a = interpolate_heights(self.level_heights(i, j, stencil),
+                                self.destagger(n, i, j, stencil), heights)
+
+        return WRFArray(a.astype(v.dtype), units=units, desc=desc)
+
+
+def interpolate_heights(z, a, heights):
+    """
+    Linearly interpolate time by level by point array a, with level heights z
+    (same shape, increasing with level), to heights (a list), returning a time
+    by height by point array.  Heights outside the levels take the value of
+    the nearest level.
+    """
+
+    h = np.asarray(heights, dtype=float)
+
+    # Level above each height in each column, kept within the levels
+    above = np.sum(z[:, None, :, :] < h[None, :, None, None], axis=2)
+    above = np.clip(above, 1, z.shape[1]-1)
+
+    z0 = np.take_along_axis(z, above-1, axis=1)
+    z1 = np.take_along_axis(z, above, axis=1)
+    a0 = np.take_along_axis(a, above-1, axis=1)
+    a1 = np.take_along_axis(a, above, axis=1)
+
+    w = np.clip((h[None, :, None] - z0)/(z1 - z0), 0, 1)
+    return a0 + w*(a1 - a0)
+
+
+def read_sites(fileName):
+    """
+    Read a list of sites from a CSV file.
+    First row is a header with either name, lat, lon or name, i, j columns;
+    lines starting with # are ignored.
+    Returns names, and either (lats, lons) or (zero-indexed is, js) with the
+    other set to None.
+    """
+
+    with open(fileName, 'rb') as f:
+        rows = [_ for _ in csv.reader(f) if _ and not _[0].startswith('#')]
+
+    if not rows:
+        print 'ERROR:  No sites found in %s' % fileName
+        raise SystemExit
+
+    header = [_.strip().lower() for _ in rows[0]]
+    rows = rows[1:]
+
+    if header == ['name', 'lat', 'lon']:
+        names = [_[0].strip() for _ in rows]
+        ll = (np.array([float(_[1]) for _ in rows]), np.array([float(_[2]) for _ in rows]))
+        ij = None
+    elif header == ['name', 'i', 'j']:
+        names = [_[0].strip() for _ in rows]
+        ll = None
+        ij = (np.array([int(_[1]) for _ in rows])-1, np.array([int(_[2]) for _ in rows])-1)
+    else:
+        print 'ERROR:  Expecting name,lat,lon or name,i,j header in %s' % fileName
+        raise SystemExit
+
+    if len(set(names)) != len(names):
+        print 'ERROR:  Site names in %s must be unique' % fileName
+        raise SystemExit
+
+    return names, ll, ij
+
+
+def read_regions(fileName):
+    """
+    Read a list of regions from a GeoJSON file of (multi)polygons, named by
+    their name property, or from an .npy (one region) or .npz (one region
+    per array) file of masks over the grid; either boolean or the fraction
+    (0 to 1) of each cell within the region.
+    Returns names, and for each region either a list of polygons (each a
+    list of rings, each a tuple of longitude and latitude arrays) or a mask.
+    """
+
+    ext = os.path.splitext(fileName)[1].lower()
+
+    if ext == '.npy':
+        names = [os.path.splitext(os.path.basename(fileName))[0]]
+        shapes = [np.load(fileName)]
+    elif ext == '.npz':
+        with np.load(fileName) as f:
+            names = sorted(f.files)
+            shapes = [f[_] for _ in names]
+    else:
+        with open(fileName) as f:
+            geojson = json.load(f)
+
+        if geojson.get('type') == 'FeatureCollection':
+            features = geojson['features']
+        elif geojson.get('type') == 'Feature':
+            features = [geojson]
+        else:
+            features = [{'geometry': geojson, 'properties': {}}]
+
+        names, shapes = [], []
+        for n, feature in enumerate(features, 1):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                print 'ERROR:  Region %d of %s is not a Polygon or MultiPolygon' % (n, fileName)
+                raise SystemExit
+            properties = feature.get('properties') or {}
+            names.append(unicode(properties.get('name') or properties.get('NAME') or
+                                 feature.get('id') or 'region%03d' % n))
+            shapes.append([[(center(np.array([_[0] for _ in ring], dtype=float)),
+                             np.array([_[1] for _ in ring], dtype=float)) for ring in polygon]
+                           for polygon in polygons])
+
+    if not names:
+        print 'ERROR:  No regions found in %s' % fileName
+        raise SystemExit
+
+    if len(set(names)) != len(names):
+        print 'ERROR:  Region names in %s must be unique' % fileName
+        raise SystemExit
+
+    return names, shapes
+
+
+def inside_polygon(rings, lat, lon):
+    """
+    Return whether points at latitudes, longitudes (arrays) are within the
+    polygon of rings (exterior then any holes; see read_regions).
+    """
+
+    inside = np.zeros(np.shape(lat), dtype=bool)
+    for x, y in rings:
+        for x1, y1, x2, y2 in zip(x[:-1], y[:-1], x[1:], y[1:]):
+            if y1 == y2:
+                continue
+            crosses = ((y1 > lat) != (y2 > lat)) & (lon < x1 + (lat-y1)*(x2-x1)/(y2-y1))
+            inside ^= crosses
+    return inside
+
+
+# Points along each side of a grid cell sampled to find how much of it is
+# within a polygon
+REGION_SAMPLES = 4
+
+
+def region_weights(w, shapes, samples=REGION_SAMPLES):
+    """
+    Work out which grid cells of w are within each of regions shapes (see
+    read_regions), and by how much, once for all chunks.  Returns a
+    dictionary of the grid indices i, j (arrays) of all cells within any
+    region, and, for each region in turn, the indices (into i, j) of its
+    cells (cells), where in cells each region starts (starts), the fraction
+    of each cell within the region (fraction), and the area of each cell
+    relative to the others (area; from the map scale factor, if any).
+    The fraction of a cell within a polygon is that of samples by samples
+    points within it; a region smaller than a cell is given the cell it
+    falls in.
+    """
+
+    ni, nj = w.ni, w.nj
+    lat, lon = w.xlat.astype(float), center(w.xlon.astype(float))
+
+    # Latitude, longitude at fractional grid indices (bilinear)
+    def at(a, fi, fj):
+        i0 = np.clip(np.floor(fi).astype(int), 0, ni-2)
+        j0 = np.clip(np.floor(fj).astype(int), 0, nj-2)
+        di, dj = fi-i0, fj-j0
+        return a[i0, j0]*(1-di)*(1-dj) + a[i0+1, j0]*di*(1-dj) + \
+            a[i0, j0+1]*(1-di)*dj + a[i0+1, j0+1]*di*dj
+
+    # Largest step (degrees) between neighbouring cells; cells further than
+    # that outside a polygon's bounds are never within it
+    step = max(np.abs(np.diff(lat, axis=0)).max(), np.abs(np.diff(lat, axis=1)).max(),
+               np.abs(center(np.diff(lon, axis=0))).max(), np.abs(center(np.diff(lon, axis=1))).max())
+
+    offsets = (np.arange(samples)+0.5)/samples - 0.5
+
+    fractions = []
+    for n, shape in enumerate(shapes):
+
+        if isinstance(shape, np.ndarray):
+            if shape.shape != (ni, nj):
+                print 'ERROR:  Mask %d is %s rather than the %d by %d grid' % (n+1, shape.shape, ni, nj)
+                raise SystemExit
+            fraction = np.clip(shape.astype(float), 0, 1)
+
+        else:
+            fraction = np.zeros((ni, nj))
+            for rings in shape:
+                x, y = np.concatenate([_[0] for _ in rings]), np.concatenate([_[1] for _ in rings])
+                ci, cj = np.nonzero((lat >= y.min()-step) & (lat <= y.max()+step) &
+                                    (lon >= x.min()-step) & (lon <= x.max()+step))
+                if not len(ci):
+                    continue
+
+                # Sample points within each candidate cell
+                fi = (ci[:, None, None] + offsets[None, :, None]).repeat(samples, 2)
+                fj = (cj[:, None, None] + offsets[None, None, :]).repeat(samples, 1)
+                within = inside_polygon(rings, at(lat, fi, fj), at(lon, fi, fj))
+                fraction[ci, cj] = np.minimum(1, fraction[ci, cj] + within.mean(axis=(1, 2)))
+
+            # Too small to catch any sample; take the cell it is in
+            if not fraction.any():
+                x, y = shape[0][0]
+                i, j = w.ll2ij(np.array([y.mean()]), np.array([x.mean()]))
+                if 0 <= i[0] < ni and 0 <= j[0] < nj:
+                    fraction[i[0], j[0]] = 1
+
+        if not fraction.any():
+            print 'ERROR:  Region %d is not within the grid' % (n+1)
+            raise SystemExit
+
+        fractions.append(fraction)
+
+    # All cells within any region, once
+    within = np.any(fractions, axis=0)
+    i, j = np.nonzero(within)
+    point = -np.ones((ni, nj), dtype=int)
+    point[i, j] = np.arange(len(i))
+
+    cells, starts, fraction = [], [], []
+    for f in fractions:
+        fi, fj = np.nonzero(f)
+        starts.append(sum(len(_) for _ in cells))
+        cells.append(point[fi, fj])
+        fraction.append(f[fi, fj])
+
+    if 'MAPFAC_M' in w.v:
+        area = 1/w.v['MAPFAC_M'][0].astype(float)**2
+    else:
+        area = np.ones((ni, nj))
+
+    cells = np.concatenate(cells)
+    return {'i': i, 'j': j, 'cells': cells, 'starts': np.array(starts),
+            'fraction': np.concatenate(fraction), 'area': area[i, j][cells]}
+
+
+# Derived variables; registered (see variable) in the order they are output
+VARIABLES = collections.OrderedDict()
+
+
+def variable(name, sources, units, decimals, rotate=False, vector=False):
+    """
+    Register a formula for the derived variable name, given its sources (WRF
+    variables or other derived variables) as time by point arrays.
+    Results are in units, rounded to decimals.  If rotate, the first two
+    sources are grid-relative vector components, rotated to east and north
+    before being handed to the formula.  If vector, e.g. a direction, it is
+    not reduced over a region but derived from the mean of its sources.
+    Formulas must not modify their sources, which are shared.
+    """
+
+    def register(formula):
+        VARIABLES[name] = {'sources': sources, 'units': units, 'decimals': decimals,
+                           'rotate': rotate, 'vector': vector, 'formula': formula}
+        return formula
+
+    return register
+
+
+# Screen temperature (2m drybulb)
+# WRF is Kelvin; convert to Celsius
+@variable(u'Drybulb Temperature', ['T2'], u'C', 1)
+def drybulb_temperature(T2):
+    return T2 - 273.15
+
+
+# Screen humidity ratio (2m)
+# WRF is kg/kg (dry air); convert to g/kg (dry air)
+@variable(u'Humidity Ratio', ['Q2'], u'g/kg', 2)
+def humidity_ratio(Q2):
+    return Q2*1000.
+
+
+# Screen relative humidity
+# WRF is fraction [0,1]; convert to percentage
+@variable(u'Relative Humidity', ['RH02'], u'%', 0)
+def relative_humidity(RH02):
+    return RH02*100.
+
+
+# Surface pressure
+# WRF is in Pa
+@variable(u'Surface Pressure', ['PSFC'], u'Pa', 2)
+def surface_pressure(PSFC):
+    return PSFC
+
+
+# 10m winds
+# WRF is vector and aligned with grid; need to rotate 'em
+# Convert to wind speed; m/s
+@variable(u'Wind Speed', ['U10', 'V10'], u'm/s', 1, rotate=True)
+def wind_speed(U10, V10):
+    return np.sqrt(U10**2+V10**2)
+
+
+# Convert to wind direction; degrees CW from North (azimuth/compass)
+@variable(u'Wind Direction', ['U10', 'V10'], u'deg', 0, rotate=True, vector=True)
+def wind_direction(U10, V10):
+    return np.mod(90 - np.degrees(np.arctan2(-V10, -U10)), 360)
+
+
+# Shortwave down or Global Horizontal Radiation
+# WRF is instantaneous W/m2
+# We would like W·hr/m² i.e. integrated over previous hour
+# Approximate with average value of current & previous hour
+@variable(u'Global Horizontal Radiation', ['SWDOWN'], u'Wh/m2', 0)
+def global_horizontal_radiation(SWDOWN):
+    GHR = SWDOWN.copy()
+    GHR[1:] = (SWDOWN[1:] + SWDOWN[0:-1])/2.0
+    return GHR
+
+
+# Precipitation is total accumulated since *start of sim*
+# Need hourly mm so need to subtract previous from current
+@variable(u'Precipitation', ['TACC_PRECIP'], u'mm', 3)
+def precipitation(TACC_PRECIP):
+    P = TACC_PRECIP.copy()
+    P[1:] = TACC_PRECIP[1:] - TACC_PRECIP[0:-1]
+    return P
+
+
+# Snow is as per precipitation but water equivalent
+@variable(u'Snow', ['TACC_SNOW'], u'mm', 3)
+def snow(TACC_SNOW):
+    S = TACC_SNOW.copy()
+    S[1:] = TACC_SNOW[1:] - TACC_SNOW[0:-1]
+    return S
+
+
+# Variables output unless asked for others
+DEFAULT_VARIABLES = list(VARIABLES)
+
+
+# Can easily add more variables at this point, e.g.
+
+# Skin temperature in K, converting to C
+@variable(u'Surface Skin Temperature', ['TSK'], u'C', 1)
+def surface_skin_temperature(TSK):
+    return TSK - 273.15
+
+
+# Screen dewpoint from vapour pressure (Bolton, 1980)
+@variable(u'Dewpoint Temperature', ['Q2', 'PSFC'], u'C', 1)
+def dewpoint_temperature(Q2, PSFC):
+    x = np.log(np.maximum(Q2*PSFC/(0.622+Q2), 1e-3)/611.2)
+    return 243.5*x/(17.67-x)
+
+
+def hub_height(height):
+    """
+    Register wind speed and direction at height (m above ground), returning
+    their names.  Sources named like U@80 are 3D WRF variables interpolated
+    to that height (see WRFDataset.extract_heights).
+    """
+
+    u, v = 'U@%g' % height, 'V@%g' % height
+    names = [u'Wind Speed %gm' % height, u'Wind Direction %gm' % height]
+
+    variable(names[0], [u, v], u'm/s', 1, rotate=True)(wind_speed)
+    variable(names[1], [u, v], u'deg', 0, rotate=True, vector=True)(wind_direction)
+
+    return names
+
+
+def variable_lookup(names):
+    """
+    Return registered variables given names, either long (e.g. Drybulb
+    Temperature) or short (e.g. Drybulb_Temperature), ignoring case.
+    """
+
+    lookup = {}
+    for name in VARIABLES:
+        lookup[name.lower()] = name
+        lookup[variable_name(name).lower()] = name
+
+    found = []
+    for name in names:
+        try:
+            found.append(lookup[name.lower()])
+        except KeyError:
+            print 'ERROR:  Unknown variable %s; choose from %s' % (
+                name, ', '.join(variable_name(_) for _ in VARIABLES))
+            raise SystemExit
+
+    return found
+
+
+def dechunk(w, i, j, stencil=None, ll=None, variables=DEFAULT_VARIABLES, rounded=True,
+            regions=None):
+    """
+    Extract derived variables (see VARIABLES) at grid indices i, j (arrays).
+    Each WRF variable they need is read exactly once, as a block covering all
+    points, no matter how many variables need it.
+    If a stencil (see WRFDataset.stencil) is supplied, the variables are
+    instead interpolated to the points at latitudes, longitudes ll.
+    If regions (see region_weights) are supplied, the points are the cells
+    within them, and the variables are reduced over each (see region_series).
+    Returns lists of names, units, descriptions (from WRF) and time by point
+    (or region) data; rounded to each variable's decimals unless not rounded.
+    """
+
+    if stencil:
+        extract = lambda n: w.extract_stencil(n, stencil)
+        rotate = lambda u, v: w.rotate(u, v, ll[0], ll[1])
+    else:
+        extract = lambda n: w.extract_points(n, i, j)
+        rotate = lambda u, v: w.rotate_ij(u, v, i, j)
+
+    # What has been read, rotated, derived, and their descriptions
+    read = {}
+    rotated = {}
+    derived = {}
+    described = {}
+
+    # Heights wanted of 3D variables, e.g. U@80, so all are done at once
+    heights = collections.defaultdict(set)
+    aloft = {}
+    def scan(n):
+        for _ in VARIABLES[n]['sources']:
+            if _ in VARIABLES:
+                scan(_)
+            elif '@' in _:
+                heights[_.split('@')[0]].add(float(_.split('@')[1]))
+    for n in variables:
+        scan(n)
+
+    def source(n):
+        if n in VARIABLES:
+            return derive(n)
+        if n not in read:
+            if '@' in n:
+                m, height = n.split('@')
+                h = sorted(heights[m])
+                if m not in aloft:
+                    aloft[m] = w.extract_heights(m, h, i, j, stencil)
+                a = aloft[m]
+                read[n] = WRFArray(a[:, h.index(float(height))], units=a.units, desc=a.desc)
+                described[n] = u'%s at %s m' % (a.desc, height)
+            else:
+                read[n] = extract(n)
+                described[n] = read[n].desc
+        return read[n]
+
+    def arguments(n):
+        var = VARIABLES[n]
+        args = [source(_) for _ in var['sources']]
+        if var['rotate']:
+            key = tuple(var['sources'][:2])
+            if key not in rotated:
+                rotated[key] = rotate(*args[:2])
+            args[:2] = rotated[key]
+        described[n] = u', '.join(described[_] for _ in var['sources'])
+        return args
+
+    def derive(n):
+        if n not in derived:
+            derived[n] = VARIABLES[n]['formula'](*arguments(n))
+        return derived[n]
+
+    # Variables
+    names = []
+    data = []
+    units = []
+    descs = []
+
+    for n in variables:
+        names.append(n)
+        if regions:
+            if VARIABLES[n]['vector']:
+                data.append(VARIABLES[n]['formula'](*[aggregate(_, regions)['mean']
+                                                      for _ in arguments(n)]))
+            else:
+                data.append(derive(n))
+        elif rounded:
+            data.append(np.round(derive(n), decimals=VARIABLES[n]['decimals']))
+        else:
+            data.append(derive(n))
+        units.append(VARIABLES[n]['units'])
+        descs.append(described[n])
+
+    if regions:
+        return region_series(names, units, descs, data, regions)
+
+    return names, units, descs, data
+
+
+# How each derived variable is reduced over a region
+REDUCTIONS = ['mean', 'min', 'max', 'sum']
+
+
+def aggregate(a, regions):
+    """
+    Reduce a time by point array (points as per region_weights) to a time
+    by region array for each of REDUCTIONS: the mean weighted by area of
+    the cells within, minimum, maximum, and the sum over cells counting
+    each by the fraction of it within.
+    """
+
+    a = np.asarray(a)[:, regions['cells']]
+    starts = regions['starts']
+    fraction = regions['fraction']
+    weight = fraction*regions['area']
+
+    return {
+        'mean': np.add.reduceat(a*weight, starts, axis=1)/np.add.reduceat(weight, starts),
+        'min': np.minimum.reduceat(a, starts, axis=1),
+        'max': np.maximum.reduceat(a, starts, axis=1),
+        'sum': np.add.reduceat(a*fraction, starts, axis=1),
+    }
+
+
+def region_series(names, units, descs, data, regions):
+    """
+    Reduce derived variables (as per dechunk) at all points within regions
+    (see region_weights) to time by region series of each of REDUCTIONS.
+    Vector variables, e.g. wind directions, are instead already time by
+    region, derived from the mean of their sources, and only that is output.
+    Returns lists of names, units, descriptions and time by region data.
+    """
+
+    series = ([], [], [], [])
+    for n, u, d, a in zip(names, units, descs, data):
+        if VARIABLES[n]['vector']:
+            reduced = {'mean': a}
+        else:
+            reduced = aggregate(a, regions)
+        for r in REDUCTIONS:
+            if r not in reduced:
+                continue
+            series[0].append(u'%s %s' % (n, r))
+            series[1].append(u)
+            series[2].append(u'%s of %s' % (r, d))
+            series[3].append(np.round(reduced[r], decimals=VARIABLES[n]['decimals']))
+
+    return series
+
+
+def hour_ending(times, startDate):
+    """
+    Given an array of datetime64 times, return which are after startDate
+    (i.e. not spin-up) along with their year, month, day and hour arrays,
+    where hours are hour-ending i.e. [1,24].
+    """
+
+    valid = times > np.datetime64(startDate)
+
+    # Dial time back a smidge so that we can put hours [1,24]
+    t = times[valid] - np.timedelta64(1, 's')
+
+    year = t.astype('datetime64[Y]')
+    month = t.astype('datetime64[M]')
+    day = t.astype('datetime64[D]')
+
+    return valid, (
+        year.astype(int) + 1970,
+        (month - year).astype(int) + 1,
+        (day - month).astype(int) + 1,
+        (t - day).astype('timedelta64[h]').astype(int) + 1
+    )
+
+
+def variable_name(name):
+    """
+    Turn a long name e.g. Drybulb Temperature into a variable name
+    e.g. Drybulb_Temperature.
+    """
+    return re.sub(r'\W+', '_', name).strip('_')
+
+
+class SeriesWriter(object):
+    """
+    Base class for writing de-chunked time series of a number of sites.
+    Subclasses provide header, called once with information about the sites
+    and variables, and write, called for each chunk in order.
+    """
+
+    def __init__(self, fileName, sites):
+        self.fileName = fileName
+        self.sites = sites
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored):
+        self.close()
+
+    def header(self, domain, lat, lon, hgt, names, units, descs):
+        raise NotImplementedError
+
+    def write(self, times, startDate, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# Default memory budget (MB) of slabs when stitching whole grids
+GRID_MEMORY = 256
+
+# Vertical dimensions whose levels can be picked when stitching
+LEVEL_DIMENSIONS = (u'bottom_top', u'bottom_top_stag')
+
+
+# Lines of header atop each CSV file
+CSV_HEADER_LINES = 3
+
+
+class CSVWriter(SeriesWriter):
+    """
+    Write de-chunked time series to CSV files, one per site.
+    Files are kept open from header to close.
+    """
+
+    def __init__(self, fileNames, sites=None):
+        SeriesWriter.__init__(self, fileNames, sites)
+        self.fileNames = fileNames
+        self.files = []
+        self.old = []
+
+    def resume(self, append=False):
+        """
+        Reopen existing files to add more chunks, keeping their header.
+        If append, all new chunks follow the existing ones.  Otherwise, new
+        files are written with the existing rows copied across (see copy) in
+        between new chunks, and swapped in on close.
+        """
+
+        for fileName in self.fileNames:
+            if append:
+                self.files.append(open(fileName, 'a'))
+            else:
+                old = open(fileName)
+                f = open(fileName + '.tmp', 'w')
+                for _ in range(CSV_HEADER_LINES):
+                    f.write(old.readline())
+                self.old.append(old)
+                self.files.append(f)
+
+    def copy(self, rows):
+        """
+        Copy rows across from existing files (see resume).
+        """
+        for old, f in zip(self.old, self.files):
+            f.writelines(itertools.islice(old, rows))
+
+    def header(self, domain, lat, lon, hgt, names, units, descs=None):
+        """
+        Open files and write out information about each site along with
+        variable names and units.
+        """
+
+        for s, fileName in enumerate(self.fileNames):
+
+            f = open(fileName, 'w')
+            self.files.append(f)
+
+            # Write out some information about the location
+            f.write(('# %s %.4f degN %.4f degE %.1f m\n' %
+                (domain, lat[s], lon[s], hgt[s])).encode('utf8')
+            )
+
+            # The variables
+            f.write((','.join(['Year', 'Month', 'Day', 'Hour'] + names)+'\n').encode('utf8'))
+
+            # The units
+            f.write((','.join(['yyyy', 'mm', 'dd', 'hh'] + units)+'\n').encode('utf8'))
+
+    def write(self, times, startDate, data):
+        """
+        Write out data (list of time by site arrays) for all times after
+        startDate (i.e. ignoring spin-up).
+        Formatting is done a column at a time for all times and sites.
+        """
+
+        valid, ymdh = hour_ending(times, startDate)
+        if not np.any(valid):
+            return 0
+
+        # Date columns, common to all sites
+        rows = np.char.mod('%d', ymdh[0])
+        for x in ymdh[1:]:
+            rows = np.char.add(np.char.add(rows, ','), np.char.mod('%d', x))
+
+        # Data columns, variable by time by site
+        columns = np.char.mod('%.6g', np.array([_[valid] for _ in data], dtype=np.float64))
+
+        for s, f in enumerate(self.files):
+            site = rows
+            for column in columns[..., s]:
+                site = np.char.add(np.char.add(site, ','), column)
+            f.write('\n'.join(site.tolist()) + '\n')
+
+        return len(rows)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+        # Swap in any spliced files
+        for old, fileName in zip(self.old, self.fileNames):
+            with open(fileName + '.tmp', 'a') as f:
+                f.writelines(old)
+            old.close()
+            os.rename(fileName + '.tmp', fileName)
+        self.old = []
+
+
+class NetCDFWriter(SeriesWriter):
+    """
+    Write de-chunked time series of all sites to a single CF-style
+    (timeSeries) netCDF file with a station dimension.
+    Times are the end of each hour.
+    """
+
+    def header(self, domain, lat, lon, hgt, names, units, descs):
+        """
+        Create file with sites, variables, their units and descriptions.
+        """
+
+        self.f = f = Dataset(self.fileName, 'w', format='NETCDF4')
+
+        f.Conventions = 'CF-1.6'
+        f.featureType = 'timeSeries'
+        f.title = '%s de-chunked' % domain
+        f.source = 'ems_dechunk.py'
+
+        f.createDimension('time', None)
+        f.createDimension('station', len(self.sites))
+
+        v = f.createVariable('time', 'f8', ('time',))
+        v.standard_name = 'time'
+        v.long_name = 'end of hour'
+        v.units = 'hours since 1970-01-01 00:00:00'
+        v.calendar = 'standard'
+
+        v = f.createVariable('station_name', str, ('station',))
+        v.long_name = 'station name'
+        v.cf_role = 'timeseries_id'
+        for s, site in enumerate(self.sites):
+            v[s] = site
+
+        for n, x, u, l in [('lat', lat, 'degrees_north', 'latitude'),
+                           ('lon', lon, 'degrees_east', 'longitude'),
+                           ('alt', hgt, 'm', 'height')]:
+            v = f.createVariable(n, 'f4', ('station',))
+            v.standard_name = l
+            v.units = u
+            v[:] = x
+
+        # Chunk for reading long time series of a few stations
+        chunks = (744, min(len(self.sites), 64))
+
+        self.variables = []
+        for name, unit, desc in zip(names, units, descs):
+            v = f.createVariable(variable_name(name), 'f4', ('time', 'station'),
+                                 zlib=True, chunksizes=chunks)
+            v.long_name = name
+            v.units = unit
+            v.description = desc
+            v.coordinates = 'time lat lon alt station_name'
+            self.variables.append(v)
+
+    def write(self, times, startDate, data):
+        """
+        Append data (list of time by site arrays) for all times after
+        startDate (i.e. ignoring spin-up), a variable at a time.
+        """
+
+        valid = times > np.datetime64(startDate)
+        if not np.any(valid):
+            return
+
+        time = self.f.variables['time']
+        n0 = len(time)
+        n1 = n0 + np.sum(valid)
+
+        time[n0:n1] = (times[valid] - np.datetime64(0, 's'))/np.timedelta64(1, 'h')
+        for v, x in zip(self.variables, data):
+            v[n0:n1, :] = x[valid]
+
+    def close(self):
+        if hasattr(self, 'f'):
+            self.f.close()
+
+
+class NPZWriter(SeriesWriter):
+    """
+    Write de-chunked time series of all sites to a single compressed numpy
+    .npz bundle.  Each variable is a time by site array; units and
+    descriptions ride along as arrays of strings.
+    Times are the end of each hour.
+    Each chunk is appended to a raw file per variable alongside as it comes,
+    and these are only bundled (compressed from disk) on close, so that the
+    whole campaign need never fit in memory.
+    """
+
+    def header(self, domain, lat, lon, hgt, names, units, descs):
+        self.arrays = {
+            'domain': np.array(domain),
+            'sites': np.array(self.sites),
+            'lat': np.asarray(lat, dtype=np.float32),
+            'lon': np.asarray(lon, dtype=np.float32),
+            'hgt': np.asarray(hgt, dtype=np.float32),
+            'names': np.array([variable_name(_) for _ in names]),
+            'long_names': np.array(names),
+            'units': np.array(units),
+            'descs': np.array(descs),
+        }
+        self.tmpDir = tempfile.mkdtemp(prefix='.npz', dir=os.path.dirname(os.path.abspath(self.fileName)))
+        self.raw = collections.OrderedDict(
+            (name, open(os.path.join(self.tmpDir, '%s.raw' % name), 'wb'))
+            for name in ['time'] + list(self.arrays['names']))
+        self.kinds = {}
+        self.rows = 0
+
+    def append(self, name, a):
+        self.kinds[name] = (a.dtype, a.shape[1:])
+        a.tofile(self.raw[name])
+
+    def write(self, times, startDate, data):
+        valid = times > np.datetime64(startDate)
+        self.append('time', np.ascontiguousarray(times[valid]))
+        for name, x in zip(self.arrays['names'], data):
+            self.append(name, np.ascontiguousarray(x[valid], dtype=np.float32))
+        self.rows += np.count_nonzero(valid)
+
+    def close(self):
+        if not hasattr(self, 'arrays'):
+            return
+        try:
+            with zipfile.ZipFile(self.fileName, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+
+                for name, a in self.arrays.items():
+                    npyFile = os.path.join(self.tmpDir, '%s.npy' % name)
+                    np.save(npyFile, a)
+                    z.write(npyFile, '%s.npy' % name)
+
+                # Raw rows behind a header of their final shape
+                for name, f in self.raw.items():
+                    f.close()
+                    dtype, shape = self.kinds.get(name, (np.dtype('datetime64[s]'), ()) if name == 'time'
+                                                  else (np.dtype(np.float32), (len(self.sites),)))
+                    npyFile = os.path.join(self.tmpDir, '%s.npy' % name)
+                    with open(npyFile, 'wb') as npy:
+                        np.lib.format.write_array_header_1_0(npy, {
+                            'descr': np.lib.format.dtype_to_descr(dtype),
+                            'fortran_order': False, 'shape': (self.rows,) + shape})
+                        with open(f.name, 'rb') as raw:
+                            shutil.copyfileobj(raw, npy, 1024**2)
+                    os.remove(f.name)
+                    z.write(npyFile, '%s.npy' % name)
+                    os.remove(npyFile)
+        finally:
+            shutil.rmtree(self.tmpDir)
+
+
+class ParquetWriter(SeriesWriter):
+    """
+    Write de-chunked time series of all sites to a single Parquet table
+    with a row per site and time (end of hour), a row group per chunk.
+    Units and descriptions are kept as column metadata, and information
+    about the sites as table metadata.
+    """
+
+    def header(self, domain, lat, lon, hgt, names, units, descs):
+
+        if pa is None:
+            print 'ERROR:  Parquet output requires pyarrow'
+            raise SystemExit
+
+        fields = [pa.field('site', pa.string()), pa.field('time', pa.timestamp('s'))]
+        for name, unit, desc in zip(names, units, descs):
+            fields.append(pa.field(name, pa.float32(), metadata={
+                'units': unit.encode('utf8'), 'description': desc.encode('utf8')
+            }))
+
+        sites = dict((site, {'lat': float(lat[s]), 'lon': float(lon[s]), 'hgt': float(hgt[s])})
+                     for s, site in enumerate(self.sites))
+
+        self.schema = pa.schema(fields, metadata={
+            'domain': domain.encode('utf8'), 'sites': json.dumps(sites)
+        })
+        self.f = pq.ParquetWriter(self.fileName, self.schema)
+
+    def write(self, times, startDate, data):
+
+        valid = times > np.datetime64(startDate)
+        if not np.any(valid):
+            return
+
+        # Site by site, i.e. transpose
+        n = np.sum(valid)
+        arrays = [
+            pa.array(np.repeat(np.array(self.sites, dtype=object), n), type=pa.string()),
+            pa.array(np.tile(times[valid].astype('datetime64[s]'), len(self.sites)), type=pa.timestamp('s'))
+        ]
+        for x in data:
+            arrays.append(pa.array(np.asarray(x[valid], dtype=np.float32).T.ravel()))
+
+        self.f.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if hasattr(self, 'f'):
+            self.f.close()
+
+
+# Output formats, their writer classes, and file extensions
+WRITERS = {
+    'csv': (CSVWriter, 'csv'),
+    'netcdf': (NetCDFWriter, 'nc'),
+    'npz': (NPZWriter, 'npz'),
+    'parquet': (ParquetWriter, 'parquet'),
+}
+
+
+def extract_chunk(job):
+    """
+    Extract the standard set of variables from a single chunk's wrfout file.
+    job is a dictionary of wrfFile, siteLL, siteIJ, regions (see
+    region_weights; in which case sites are regions), spinup, interp, cache,
+    memory and header so that it can be handed to a pool of workers.
+    Returns a dictionary of everything needed to write out the chunk.
+    """
+
+    siteLL, siteIJ, interp = job['siteLL'], job['siteIJ'], job['interp']
+    regions = job.get('regions')
+
+    # Time and resources taken; this may well be in a worker process
+    t0, ru0 = time.time(), resource.getrusage(resource.RUSAGE_SELF)
+
+    with WRFDataset(job['wrfFile'], cache=job['cache'],
+                    memory=job.get('memory', READ_CACHE_MAX)) as w:
+
+        # If latitude, longitude supplied, find indices (all at once); all
+        # cells within regions are read at once too
+        if regions:
+            ij = regions['i'], regions['j']
+        elif siteLL:
+            ij = w.ll2ij(*siteLL)
+        else:
+            ij = siteIJ
+
+        # Check that all sites fall within the grid; let caller complain
+        inside = (ij[0] >= 0) & (ij[0] < w.ni) & (ij[1] >= 0) & (ij[1] < w.nj)
+        chunk = {'ij': ij, 'inside': inside}
+        if not np.all(inside):
+            return chunk
+
+        # Calculate time of valid records
+        spinupDate = w.start_date
+        spinupTimedelta = datetime.timedelta(hours=job['spinup'])
+        chunk['startDate'] = spinupDate + spinupTimedelta
+        chunk['times'] = w.times64
+
+        # Interpolate to sites rather than snapping to nearest
+        if interp and siteLL and not regions:
+            stencil = w.stencil(*w.ll2ij(*siteLL, exact=True), method=interp)
+        else:
+            stencil = None
+
+        # Variables, time by site
+        # ... or time by region, for all regions in one go
+        chunk['names'], chunk['units'], chunk['descs'], chunk['data'] = \
+            dechunk(w, *ij, stencil=stencil, ll=siteLL, variables=job['variables'],
+                    regions=regions)
+
+        # Latitude, Longitude, Elevation; of regions, their (area weighted) mean
+        if job['header']:
+            for n in ['XLAT', 'XLONG', 'HGT']:
+                if regions:
+                    chunk[n] = aggregate(w.extract_points(n, *ij, t=slice(0, 1)), regions)['mean'][0]
+                elif stencil:
+                    chunk[n] = w.extract_stencil(n, stencil, t=0)
+                else:
+                    chunk[n] = w.extract_points(n, *ij, t=0)
+
+        # How much was read to get it
+        chunk['stats'] = dict(w.stats)
+
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    chunk['usage'] = {'wall': time.time()-t0, 'rss': ru.ru_maxrss,
+                      'cpu': (ru.ru_utime-ru0.ru_utime) + (ru.ru_stime-ru0.ru_stime)}
+
+    return chunk
+
+
+def stitch(fileName, domain, runs, names, spinup=12, levels=None,
+           budget=GRID_MEMORY*1024**2, cache=None, metrics=None):
+    """
+    Stitch whole grids of variables names from a series of chunks (runs,
+    a list of runDir, wrfFile) into a single continuous netCDF file along
+    time, dropping spin-up.  If levels (a slice) is supplied, only those
+    vertical levels are kept.
+    Chunks are copied over a slab of times at a time, each slab no larger
+    than budget bytes, so the grid need never fit in memory.
+    If metrics (see ems_metrics) supplied, each chunk is a stage.
+    """
+
+    metrics = metrics or Metrics(os.devnull)
+
+    f = None
+    n0 = 0
+    last = None
+
+    for runDir, wrfFile in runs:
+
+        print 'Stitching', runDir
+
+        # Slabs are only read once; do not keep them around
+        with metrics.stage('stitch', chunk=runDir) as m, \
+                WRFDataset(wrfFile, cache=cache, memory=0) as w:
+
+            # Create file from first chunk
+            if f is None:
+
+                for n in names:
+                    if n not in w.v:
+                        print 'ERROR:  %s not found in %s' % (n, wrfFile)
+                        raise SystemExit
+                    if w.v[n].dimensions[0] != 'Time':
+                        print 'ERROR:  %s does not vary with time' % n
+                        raise SystemExit
+
+                f = Dataset(fileName, 'w', format='NETCDF4')
+
+                # Keep the WRF global attributes (projection, etc.)
+                for a in w.f.ncattrs():
+                    setattr(f, a, getattr(w.f, a))
+                f.title = '%s stitched' % domain
+                f.source = 'ems_dechunk.py'
+
+                f.createDimension('time', None)
+
+                v = f.createVariable('time', 'f8', ('time',))
+                v.standard_name = 'time'
+                v.units = 'hours since 1970-01-01 00:00:00'
+                v.calendar = 'standard'
+
+                # Grid coordinates and elevation
+                for n in ['XLAT', 'XLONG', 'HGT']:
+                    for d in w.v[n].dimensions[1:]:
+                        if d not in f.dimensions:
+                            f.createDimension(d, len(w.f.dimensions[d]))
+                    v = f.createVariable(n, 'f4', w.v[n].dimensions[1:], zlib=True)
+                    v.units = w.v[n].units
+                    v.description = w.v[n].description
+                    v[:] = w.read(w.v[n], (0, slice(None), slice(None)))
+
+                for n in names:
+
+                    # Vertical levels (not e.g. soil layers or land use
+                    # categories) are the leading dimension after time
+                    dims = ('time',) + w.v[n].dimensions[1:]
+                    for d in dims[1:]:
+                        if d not in f.dimensions:
+                            size = len(w.f.dimensions[d])
+                            if levels is not None and d in LEVEL_DIMENSIONS:
+                                size = len(xrange(*levels.indices(size)))
+                            f.createDimension(d, size)
+
+                    # Chunk by horizontal layer
+                    chunks = [1]*(len(dims)-2) + [len(f.dimensions[_]) for _ in dims[-2:]]
+
+                    v = f.createVariable(n, 'f4', dims, zlib=True, chunksizes=chunks)
+                    v.units = w.v[n].units
+                    v.description = w.v[n].description
+                    if dims[-2:] == ('south_north', 'west_east'):
+                        v.coordinates = 'XLONG XLAT'
+
+            # Valid times; after spin-up and any previous chunk
+            valid = w.times64 > np.datetime64(w.start_date + datetime.timedelta(hours=spinup))
+            if last is not None:
+                valid &= w.times64 > last
+            t = np.flatnonzero(valid)
+            if not len(t):
+                continue
+            t0, t1 = t[0], t[-1]+1
+            n1 = n0 + t1 - t0
+
+            f.variables['time'][n0:n1] = (w.times64[t0:t1] - np.datetime64(0, 's'))/np.timedelta64(1, 'h')
+
+            for n in names:
+
+                v = w.v[n]
+                index = [slice(None)]*v.ndim
+                if levels is not None and v.dimensions[1] in LEVEL_DIMENSIONS:
+                    index[1] = levels
+
+                # Times per slab
+                size = np.prod(f.variables[n].shape[1:])*np.dtype(v.dtype).itemsize
+                step = max(1, int(budget // size))
+
+                for t in xrange(t0, t1, step):
+                    index[0] = slice(t, min(t+step, t1))
+                    f.variables[n][n0+t-t0:n0+index[0].stop-t0] = w.read(v, tuple(index))
+
+            n0, last = n1, w.times64[t1-1]
+            m['read'] = w.stats['read']
+
+    if f is not None:
+        f.close()
+
+
+# Prefix of slimmed companions of wrfout files; see slim
+SLIM_PREFIX = 'wrfslim'
+
+# Grid and time variables every slimmed file keeps (if there are any)
+SLIM_GRID = ['Times', 'XTIME', 'XLAT', 'XLONG', 'HGT', 'COSALPHA', 'SINALPHA', 'MAPFAC_M']
+
+# Horizontal size of a storage chunk of a slimmed variable; chunks span all
+# times so a site's series is read from one or two chunks
+SLIM_CHUNK = 16
+
+
+def slim_file(fileName):
+    """
+    Return the slim companion of wrfout fileName (whether or not it exists).
+    """
+
+    d, base = os.path.split(fileName)
+    return os.path.join(d, base.replace('wrfout', SLIM_PREFIX, 1))
+
+
+def wrfout_files(runDir, nest):
+    """
+    Return the wrfout files of nest in runDir, including any that only their
+    slim companions (see slim) remain of.
+    """
+
+    wrfFiles = set(glob.glob(os.path.join(runDir, 'wrfprd', 'wrfout_d%02d*' % nest)))
+    for fileName in glob.glob(os.path.join(runDir, 'wrfprd', '%s_d%02d*' % (SLIM_PREFIX, nest))):
+        d, base = os.path.split(fileName)
+        wrfFiles.add(os.path.join(d, base.replace(SLIM_PREFIX, 'wrfout', 1)))
+    return sorted(wrfFiles)
+
+
+def slim_sources(variables=DEFAULT_VARIABLES):
+    """
+    Return the WRF variables needed to derive variables (see VARIABLES).
+    """
+
+    sources = []
+    def scan(n):
+        for _ in VARIABLES[n]['sources']:
+            if _ in VARIABLES:
+                scan(_)
+            elif '@' in _:
+                # Heights above ground are from geopotential and terrain
+                for m in [_.split('@')[0], 'PH', 'PHB', 'HGT']:
+                    if m not in sources:
+                        sources.append(m)
+            elif _ not in sources:
+                sources.append(_)
+    for n in variables:
+        scan(n)
+
+    return sources
+
+
+def slim(fileName, sources=None, complevel=4):
+    """
+    Write the slim companion (see slim_file) of wrfout fileName holding only
+    WRF variables sources (by default, those ems_dechunk derives its
+    default variables from) and those of the grid, compressed, and chunked
+    for reading time series.  WRFDataset reads it in preference.
+    Written to a temporary file then renamed, so never left half written.
+    Returns the slim file name.
+    """
+
+    slimName = slim_file(fileName)
+    tmpName = slimName + '.tmp'
+
+    with Dataset(fileName) as w, Dataset(tmpName, 'w', format='NETCDF4') as f:
+
+        for a in w.ncattrs():
+            setattr(f, a, getattr(w, a))
+
+        names = []
+        for n in SLIM_GRID + list(sources or slim_sources()):
+            if n in names or n not in w.variables:
+                if n not in SLIM_GRID and n not in names:
+                    logging.warning('%s not found in %s; not slimmed' % (n, fileName))
+                continue
+            names.append(n)
+
+        dims = set(itertools.chain(*[w.variables[_].dimensions for _ in names]))
+        for d in w.dimensions.values():
+            if d.name in dims:
+                f.createDimension(d.name, None if d.isunlimited() else len(d))
+
+        for n in names:
+
+            v = w.variables[n]
+
+            # All times, a layer at a time, a small patch of the grid
+            chunks = None
+            if v.dimensions[0] == 'Time' and len(v.dimensions) > 2:
+                chunks = [len(v)] + [1]*(v.ndim-3) + [min(SLIM_CHUNK, _) for _ in v.shape[-2:]]
+
+            x = f.createVariable(n, v.dtype, v.dimensions, zlib=True, shuffle=True,
+                                 complevel=complevel, chunksizes=chunks)
+            x.setncatts(dict((a, v.getncattr(a)) for a in v.ncattrs()))
+
+            # Copy a layer at a time to keep memory down
+            if v.ndim > 3:
+                for k in xrange(v.shape[1]):
+                    x[:, k] = v[:, k]
+            else:
+                x[:] = v[:]
+
+    os.rename(tmpName, slimName)
+
+    return slimName
+
+
+def output_stats(fileNames):
+    """
+    Return the size and modification time of each of fileNames (that
+    exists), as kept in the manifest.
+    """
+
+    stats = {}
+    for fileName in fileNames:
+        if os.path.exists(fileName):
+            st = os.stat(fileName)
+            stats[fileName] = [st.st_size, st.st_mtime]
+    return stats
+
+
+def main():
+
+
+    """
+    Read and form time series from a series of WRF EMS runs.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('domain', help='specify root domain')
+
+    parser_location = parser.add_mutually_exclusive_group(required=True)
+
+    parser_location.add_argument('-ll', dest='ll', metavar=('lat', 'lon'), nargs=2,
+        type=float, help='specify lat lon of desired location')
+
+    parser_location.add_argument('-ij', dest='ij', metavar=('i', 'j'), nargs=2,
+        type=int, help='specify i and j index of desired location')
+
+    parser_location.add_argument('-s', '--sites', metavar='csv',
+        help='specify CSV file of sites with name,lat,lon or name,i,j columns')
+
+    parser_location.add_argument('-r', '--regions', metavar='file',
+        help='specify GeoJSON file of polygons, or .npy/.npz file of grid masks, to output the mean, min, max and sum over')
+
+    parser_location.add_argument('-g', '--grid', metavar='var', nargs='+',
+        help='specify variables to stitch together over the whole grid into a single netCDF file')
+
+    parser.add_argument('-k', '--levels', metavar=('lo', 'hi'), nargs=2, type=int,
+        help='specify range of vertical levels to keep with --grid')
+
+    parser.add_argument('--memory', metavar='MB', default=GRID_MEMORY, type=int,
+        help='specify memory budget for reading slabs of grid with --grid, or blocks around sites')
+
+    parser.add_argument('-n', '--nest', metavar='int',  type=int,
+        help='specify nested domain; will use finest grid available if not supplied')
+
+    parser.add_argument('--spinup', dest='spinup', metavar='hours', default=12,
+        type=int, help='specify spin-up time in hours')
+
+    parser.add_argument('--interp', choices=['bilinear', 'idw'],
+        help='interpolate to -ll or site locations rather than snapping to nearest grid point')
+
+    parser.add_argument('-v', '--vars', metavar='var', nargs='+',
+        help='specify variables to output, e.g. Drybulb_Temperature Dewpoint_Temperature; '
+             'defaults to %s' % ' '.join(variable_name(_) for _ in DEFAULT_VARIABLES))
+
+    parser.add_argument('--heights', metavar='m', nargs='+', type=float,
+        help='also output wind speed and direction at heights above ground, e.g. hub heights 80 100 120')
+
+    parser.add_argument('--nocache', action='store_true',
+        help='do not cache grid geometry in static directory of domain')
+
+    parser.add_argument('-f', '--format', default='csv', choices=sorted(WRITERS),
+        help='specify output format; csv is one file per site, others are one file for all sites')
+
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help='only extract new chunks, keeping track of what has been extracted in a manifest (CSV only)')
+
+    parser.add_argument('-w', '--workers', metavar='int', default=1, type=int,
+        help='specify number of worker processes to extract chunks in parallel')
+
+    args = parser.parse_args()
+
+    # Point logging to domain.log
+    logging.basicConfig(filename='%s.log' % args.domain, level=logging.INFO,
+        format='%(asctime)s - %(message)s')
+
+    # Keep track of time and resources each stage takes
+    metrics = Metrics(metrics_file(args.domain), script='ems_dechunk', domain=args.domain)
+    start = time.time()
+
+    # Master directory
+    domainDir = os.path.join(EMS_RUN, args.domain)
+
+    # Check to see that we have a master root domain directory
+    if not os.path.isdir(domainDir):
+        print 'ERROR:  Make sure %s exists' % args.domain
+        raise SystemExit
+
+    # Figure out the number of domains
+    geo = glob.glob('%s/static/geo*.nc' % domainDir)
+    nDomains = len(geo)
+
+    # Determine which domain to extract
+    if args.nest:
+        nest = args.nest
+        # Check if requested nest exists
+        if nest > nDomains:
+            print 'ERROR: Requested nest %d not available.' % nest
+            raise SystemExit
+    else:
+        # Choose finest domain
+        nest = nDomains
+
+    # Gather up desired locations; a single location is simply an unnamed site
+    regions = None
+    if args.grid:
+        siteNames, siteLL, siteIJ = None, None, None
+    elif args.regions:
+        siteNames, siteLL, siteIJ = read_regions(args.regions)[0], None, None
+    elif args.sites:
+        siteNames, siteLL, siteIJ = read_sites(args.sites)
+    elif args.ll:
+        siteNames, siteLL, siteIJ = [None], (np.array([args.ll[0]]), np.array([args.ll[1]])), None
+    else:
+        siteNames, siteLL, siteIJ = [None], None, (np.array([args.ij[0]-1]), np.array([args.ij[1]-1]))
+
+    # Derived variables to output
+    if args.vars:
+        variables = variable_lookup(args.vars)
+    else:
+        variables = list(DEFAULT_VARIABLES)
+
+    # ... with any winds aloft
+    for height in args.heights or []:
+        variables += hub_height(height)
+
+    # Figure out our simulation directories
+    runDirs = sorted([_ for _ in glob.glob('%s_%s' % (domainDir, '[0-9]'*8)) if os.path.isdir(_)])
+
+    # Grid geometry is shared by all chunks; keep it with the domain
+    if args.nocache:
+        cacheFile = None
+    else:
+        cacheFile = os.path.join(domainDir, 'static', 'geo_em.d%02d.npz' % nest)
+
+    # Chunks that have been run
+    runs = []
+    for runDir in runDirs:
+
+        # Check if it has been run
+        wrfFiles = wrfout_files(runDir, nest)
+        if not wrfFiles:
+            logging.warning('Not extracting %s; no netCDF files; skipping' % runDir)
+            continue
 
         # Make sure we have only one file
         if len(wrfFiles) > 1:
             print 'ERROR:  Entire chunked simulation should reside in a single file'
             raise SystemExit
 
-        logging.info('Extracting from %s' % wrfFiles[0])
+        runs.append((runDir, wrfFiles[0]))
 
-        with WRFDataset(wrfFiles[0]) as w:
+    if not runs:
+        print 'ERROR:  No chunks have been run'
+        raise SystemExit
+
+    # Whole grids go to a single file
+    if args.grid:
+
+        fileName = os.path.join(EMS_RUN, '%s_grid.nc' % args.domain)
+
+        if args.levels:
+            levels = slice(args.levels[0]-1, args.levels[1])
+        else:
+            levels = None
+
+        stitch(fileName, args.domain, runs, args.grid, spinup=args.spinup,
+               levels=levels, budget=args.memory*1024**2, cache=cacheFile,
+               metrics=metrics)
+
+        print 'Wrote to', fileName
+        return
 
-            # If latitude, longitude supplied, find indices
-            if args.ll:
-                ij = w.ll2ij(*args.ll)
+    # Find sites in grid, shared by all chunks; this also primes the grid
+    # geometry cache before any workers go looking for it
+    with WRFDataset(runs[0][1], cache=cacheFile) as w:
+        if args.regions:
+            regions = region_weights(w, read_regions(args.regions)[1])
+            logging.info('Found %d cells within %d regions' % (len(regions['i']), len(siteNames)))
+        else:
+            ij = w.ll2ij(*siteLL) if siteLL else siteIJ
+
+    # Name sites
+    sites = []
+    for s, name in enumerate(siteNames):
+        if name is None:
+            name = 'i%02d_j%02d' % (ij[0][s]+1, ij[1][s]+1)
+        sites.append(name)
+
+    # Label output after the site (or region) file, or site
+    if args.sites or args.regions:
+        label = os.path.splitext(os.path.basename(args.sites or args.regions))[0]
+    else:
+        label = sites[0]
+
+    Writer, ext = WRITERS[args.format]
+
+    if Writer is CSVWriter:
+
+        # Form fileNames; one per site
+        fileNames = [os.path.join(EMS_RUN, '%s_%s.%s' % (args.domain, _, ext)) for _ in sites]
+
+        # Make sure we may keep every file open at once (twice if splicing)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < 2*len(fileNames)+64:
+            if hard == resource.RLIM_INFINITY:
+                soft = 2*len(fileNames)+64
             else:
-                ij = (args.ij[0]-1, args.ij[1]-1)
-
-            # Snap to latitude and longitude based on grid found
-            ll = w.ij2ll(*ij)
-
-            # Calculate time of valid records
-            spinupDate = w.start_date
-            spinupTimedelta = datetime.timedelta(hours=args.spinup)
-            startDate = spinupDate + spinupTimedelta
-
-            # Variables
-            names = []
-            data = []
-            units = []
-
-            # Screen temperature (2m drybulb)
-            # WRF is Kelvin; convert to Celsius
-            names.append(u'Drybulb Temperature')
-            data.append(np.round(w.extract('T2', i=ij[0], j=ij[1]) - 273.15, decimals=1))
-            units.append(u'C')
-
-            # Screen humidity ratio (2m)
-            # WRF is kg/kg (dry air); convert to g/kg (dry air)
-            names.append(u'Humidity Ratio')
-            data.append(np.round(w.extract('Q2', i=ij[0], j=ij[1])*1000., decimals=2))
-            units.append(u'g/kg')
-
-            # Screen relative humidity
-            # WRF is fraction [0,1]; convert to percentage
-            names.append(u'Relative Humidity')
-            data.append(np.round(w.extract('RH02', i=ij[0], j=ij[1])*100., decimals=0))
-            units.append(u'%')
-
-            # Surface pressure
-            # WRF is in Pa
-            names.append(u'Surface Pressure')
-            data.append(np.round(w.extract('PSFC', i=ij[0], j=ij[1]), decimals=2))
-            units.append(u'Pa')
-
-            # 10m winds
-            # WRF is vector and aligned with grid; need to rotate 'em
-            U10 = w.extract('U10', i=ij[0], j=ij[1])
-            V10 = w.extract('V10', i=ij[0], j=ij[1])
-            (U10, V10) = w.rotate(U10, V10, ll[0], ll[1])
-            # Convert to wind speed; m/s
-            names.append(u'Wind Speed')
-            data.append(np.round(np.sqrt(U10**2+V10**2), decimals=1))
-            units.append(u'm/s')
-            # Convert to wind direction; degrees CW from North (azimuth/compass)
-            names.append(u'Wind Direction')
-            data.append(np.round(np.mod(90 - np.degrees(np.arctan2(-V10, -U10)), 360), decimals=0))
-            units.append(u'deg')
-
-            # Shortwave down or Global Horizontal Radiation
-            # WRF is instantaneous W/m2
-            # We would like W·hr/m² i.e. integrated over previous hour
-            # Approximate with average value of current & previous hour
-            names.append(u'Global Horizontal Radiation')
-            SWDOWN = w.extract('SWDOWN', i=ij[0], j=ij[1])
-            SWDOWN[1:] = (SWDOWN[1:] + SWDOWN[0:-1])/2.0
-            data.append(np.round(SWDOWN, decimals=0))
-            units.append(u'Wh/m2')
-
-            # Precipitation is total accumulated since *start of sim*
-            # Need hourly mm so need to subtract previous from current
-            TACC_PRECIP = w.extract('TACC_PRECIP', i=ij[0], j=ij[1])
-            TACC_PRECIP[1:] = TACC_PRECIP[1:] - TACC_PRECIP[0:-1]
-            names.append(u'Precipitation')
-            data.append(np.round(TACC_PRECIP, 3))
-            units.append(u'mm')
-
-            # Snow is as per precipitation but water equivalent
-            TACC_SNOW = w.extract('TACC_SNOW', i=ij[0], j=ij[1])
-            TACC_SNOW[1:] = TACC_SNOW[1:] - TACC_SNOW[0:-1]
-            names.append(u'Snow')
-            data.append(np.round(TACC_SNOW, 3))
-            units.append(u'mm')
-
-            # Can easily add more variables at this point
-            # e.g. skin temperature in K, converting to C
-            #names.append(u'Surface Skin Temperature')
-            #data.append(np.round(w.extract('TSK', i=ij[0], j=ij[1])-273.15, decimals=1))
-            #units.append(u'C')
+                soft = min(hard, 2*len(fileNames)+64)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
 
-            # Print a header... just once
-            if header:
+        writer = CSVWriter(fileNames)
 
-                # Form fileName
-                fileName = os.path.join(
-                    EMS_RUN, '%s_i%02d_j%02d.csv' % (args.domain, ij[0]+1, ij[1]+1)
-                )
+    else:
 
-                # Latitude, Longitude, Elevation
-                XLAT = w.extract('XLAT', i=ij[0], j=ij[1], t=0)
-                XLON = w.extract('XLONG', i=ij[0], j=ij[1], t=0)
-                HGT = w.extract('HGT', i=ij[0], j=ij[1], t=0)
+        # Form fileName; one for all sites
+        fileNames = [os.path.join(EMS_RUN, '%s_%s.%s' % (args.domain, label, ext))]
+
+        writer = Writer(fileNames[0], sites)
+
+    # What was extracted, and how, is kept in a manifest alongside the output
+    manifestFile = os.path.join(EMS_RUN, '%s_%s.manifest' % (args.domain, label))
+    manifest = {
+        'settings': json.loads(json.dumps({
+            'sites': siteNames,
+            'regions': os.path.abspath(args.regions) if args.regions else None,
+            'll': [_.tolist() for _ in siteLL] if siteLL else None,
+            'ij': [_.tolist() for _ in siteIJ] if siteIJ else None,
+            'nest': nest,
+            'spinup': args.spinup,
+            'interp': args.interp,
+            'variables': variables,
+            'format': args.format,
+        })),
+        'chunks': {}
+    }
+
+    # Figure out which chunks need extracting; those new or changed
+    resumed = False
+    plan = []
+    for runDir, wrfFile in runs:
+        # Whichever is read; see WRFDataset
+        st = os.stat(slim_file(wrfFile) if os.path.isfile(slim_file(wrfFile)) else wrfFile)
+        plan.append([runDir, {'wrfFile': wrfFile, 'size': st.st_size, 'mtime': st.st_mtime}])
+
+    if args.incremental:
+
+        if args.format != 'csv':
+            print 'ERROR:  Incremental de-chunking only available for CSV'
+            raise SystemExit
+
+        try:
+            with open(manifestFile) as f:
+                old = json.load(f)
+        except IOError:
+            old = None
+
+        # Start over if anything already extracted has changed, or the
+        # output has been written since (e.g. by another run)
+        if old is None or old['settings'] != manifest['settings'] or \
+                not all(os.path.exists(_) for _ in fileNames):
+            logging.info('Extracting all chunks; no matching manifest %s' % manifestFile)
+        elif old.get('outputs') != output_stats(fileNames):
+            logging.info('Extracting all chunks; output changed since manifest %s' % manifestFile)
+        elif any(_ not in dict(plan) for _ in old['chunks']):
+            logging.info('Extracting all chunks; chunks have disappeared since last time')
+        elif any(old['chunks'][r]['wrfFile'] != e['wrfFile'] or old['chunks'][r]['size'] != e['size'] or
+                 old['chunks'][r]['mtime'] != e['mtime'] for r, e in plan if r in old['chunks']):
+            logging.info('Extracting all chunks; chunks have changed since last time')
+        else:
+            for p in plan:
+                if p[0] in old['chunks']:
+                    p[1] = old['chunks'][p[0]]
+                    p.append(True)
+
+            news = [_[0] for _ in plan if len(_) == 2]
+            if not news:
+                print 'Nothing new to de-chunk'
+                return
+
+            # Splice into existing files, or simply append if all new
+            writer.resume(append=min(news) > max(old['chunks']))
+            resumed = True
+
+    # Gather up one job per new chunk
+    jobs = []
+    for p in plan:
+
+        if len(p) > 2:
+            continue
+
+        # Only the first chunk needs to supply the header (if needed)
+        jobs.append({
+            'wrfFile': p[1]['wrfFile'],
+            'siteLL': siteLL,
+            'siteIJ': siteIJ,
+            'regions': regions,
+            'spinup': args.spinup,
+            'interp': args.interp,
+            'variables': variables,
+            'cache': cacheFile,
+            'memory': args.memory*1024**2,
+            'header': not jobs and not resumed
+        })
+
+    # Farm out chunks to a pool of workers if requested;
+    # imap hands back results in chunk (i.e. chronological) order
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(extract_chunk, jobs)
+    else:
+        pool = None
+        results = itertools.imap(extract_chunk, jobs)
+
+    # Loop over all chunks
+    todo = iter(jobs)
+    for p in plan:
+
+        runDir, entry = p[:2]
+
+        # Already extracted
+        if len(p) > 2:
+            writer.copy(entry['rows'])
+            manifest['chunks'][runDir] = entry
+            continue
+
+        job, chunk = next(todo), next(results)
+
+        print 'De-chunking', runDir
 
-                with open(fileName, 'w') as f:
-                    # Write out some information about the location
-                    f.write(('# %s %.4f degN %.4f degE %.1f m\n' %
-                        (args.domain, XLAT, XLON, HGT)).encode('utf8')
-                    )
+        logging.info('Extracted from %s' % job['wrfFile'])
+        if 'stats' in chunk:
+            logging.info('Read %.1f MB (%.1f MB decompressed) in %d reads for %.3f MB; %d cache hits' % (
+                chunk['stats']['read']/1e6, chunk['stats']['touched']/1e6,
+                chunk['stats']['reads'], chunk['stats']['returned']/1e6, chunk['stats']['hits']))
+
+        # Check that all sites fall within the grid
+        ij = chunk['ij']
+        if not np.all(chunk['inside']):
+            print 'ERROR:  Locations outside of grid:', ', '.join(['%s (%d, %d)' %
+                (siteNames[_] or args.domain, ij[0][_]+1, ij[1][_]+1) for _ in np.flatnonzero(~chunk['inside'])])
+            if pool:
+                pool.terminate()
+            raise SystemExit
+
+        # Time spent reading, and the rest computing; CPU and peak memory
+        # are for extraction as a whole
+        stats, usage = chunk['stats'], chunk['usage']
+        metrics.record(stage='dechunk_read', chunk=runDir, wall=stats['seconds'],
+                       bytes=stats['read'], touched=stats['touched'], reads=stats['reads'])
+        metrics.record(stage='dechunk_compute', chunk=runDir, wall=usage['wall']-stats['seconds'],
+                       cpu=usage['cpu'], rss=usage['rss'], sites=len(ij[0]), hours=len(chunk['times']))
 
-                    # The variables
-                    names = ['Year', 'Month', 'Day', 'Hour'] + names
-                    f.write((','.join(names)+'\n').encode('utf8'))
+        # Variables, time by site
+        names, units, data = chunk['names'], chunk['units'], chunk['data']
 
-                    # The units
-                    units = ['yyyy', 'mm', 'dd', 'hh'] + units
-                    f.write((','.join(units)+'\n').encode('utf8'))
+        with metrics.stage('dechunk_write', chunk=runDir):
 
-                header = False
+            # Print a header... just once
+            if job['header']:
+
+                # Latitude, Longitude, Elevation
+                writer.header(args.domain, chunk['XLAT'], chunk['XLONG'], chunk['HGT'],
+                              names, units, chunk['descs'])
 
             # Append data
-            with open(fileName, 'a') as f:
+            entry['rows'] = writer.write(chunk['times'], chunk['startDate'], data)
 
-                # Loop carefully over all times
-                for i, t in enumerate(w.times):
+        # Note time range extracted
+        times = chunk['times'][chunk['times'] > np.datetime64(chunk['startDate'])]
+        if len(times):
+            entry['start'], entry['end'] = str(times[0]), str(times[-1])
 
-                    # Ignore everything in the spinup period
-                    if t <= startDate:
-                        continue
+        manifest['chunks'][runDir] = entry
+
+    with metrics.stage('dechunk_write') as m:
+        writer.close()
+        m['bytes'] = sum(os.path.getsize(_) for _ in fileNames if os.path.exists(_))
 
-                    # Dial time back a smidge so that we can put hours [1,24]
-                    t -= datetime.timedelta(seconds=1)
+    if pool:
+        pool.close()
+        pool.join()
 
-                    # The data
-                    datarow = ['%d' % x for x in [t.year, t.month, t.day, (t.hour+1)]]
-                    datarow.extend(['%.6g' % data[_][i] for _ in range(len(data))])
+    # Keep track of what has been extracted, and what it was written to;
+    # whether incremental or not, so that no stale manifest is left behind
+    manifest['outputs'] = output_stats(fileNames)
+    with open(manifestFile + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(manifestFile + '.tmp', manifestFile)
 
-                    f.write((','.join(datarow)+'\n').encode('utf8'))
+    metrics.record(stage='dechunk', wall=time.time()-start, chunks=len(jobs), sites=len(sites),
+                   bytes=m['bytes'])
 
-    print 'Wrote to', fileName
+    for fileName in fileNames:
+        print 'Wrote to', fileName
 
 if __name__ == "__main__":
     main()
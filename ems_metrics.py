@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import resource
+import threading
+import time
+
+
+class Metrics(object):
+    """
+    Record wall time, CPU time, peak memory (RSS) and bytes of each stage of
+    work, one JSON object per line, to a metrics file.
+    Child CPU time and peak RSS are those of the commands a stage waits on
+    with wait, so are not muddled by stages running at the same time in other
+    threads; CPU time and peak RSS of the process itself are for the whole
+    process.
+    """
+
+    def __init__(self, fileName, **fields):
+        """
+        Append to fileName, adding fields (e.g. script, domain) to every
+        record.
+        """
+
+        self.fileName = fileName
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def record(self, **fields):
+        """
+        Write a record of fields; stamped with the time if not already.
+        """
+
+        r = dict(self.fields, start=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'))
+        r.update(fields)
+        line = json.dumps(r, sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.fileName, 'a') as f:
+                f.write(line)
+
+    @contextlib.contextmanager
+    def stage(self, name, path=None, **fields):
+        """
+        Time stage name, recording it with fields once done; yields the
+        record so the stage can add to it (e.g. ok, or bytes).
+        If path (a directory) is supplied, bytes written are how much it
+        grew by.
+        """
+
+        r = dict(fields, stage=name, start=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                 cpu_children=0.0, rss_children=0)
+        size = du(path) if path else None
+
+        outer = getattr(self.local, 'stage', None)
+        self.local.stage = r
+
+        t0, ru0 = time.time(), resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            yield r
+        finally:
+            ru = resource.getrusage(resource.RUSAGE_SELF)
+            self.local.stage = outer
+
+            r['wall'] = time.time()-t0
+            r['cpu'] = (ru.ru_utime-ru0.ru_utime) + (ru.ru_stime-ru0.ru_stime)
+            r['rss'] = ru.ru_maxrss
+            if size is not None:
+                r['bytes'] = du(path) - size
+
+            self.record(**r)
+
+    def wait(self, p):
+        """
+        Wait for child process p (a subprocess.Popen) to finish, adding its
+        CPU time and peak RSS to the current stage (if any).
+        Returns its exit status.
+        """
+
+        pid, status, ru = os.wait4(p.pid, 0)
+
+        r = getattr(self.local, 'stage', None)
+        if r is not None:
+            r['cpu_children'] += ru.ru_utime + ru.ru_stime
+            r['rss_children'] = max(r['rss_children'], ru.ru_maxrss)
+
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        return p.returncode
+
+
+def metrics_file(domain):
+    """
+    Return the metrics file of domain; alongside its log.
+    """
+    return '%s.metrics' % domain
+
+
+def du(path):
+    """
+    Return total size (bytes) of the files within path, not following
+    symbolic links.
+    """
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def summary(records, top=10):
+    """
+    Print the slowest stages, totals by stage, and throughput by day.
+    """
+
+    if not records:
+        print 'No metrics'
+        return
+
+    print 'Slowest stages'
+    print '%-16s %-28s %10s %10s %10s %10s' % ('stage', 'chunk', 'wall (s)', 'cpu (s)', 'rss (MB)', 'MB')
+    for r in sorted(records, key=lambda _: -_.get('wall', 0))[:top]:
+        print '%-16s %-28s %10.1f %10.1f %10.1f %10s' % (
+            r['stage'], os.path.basename(r.get('chunk') or '-'), r['wall'],
+            r.get('cpu', 0) + r.get('cpu_children', 0),
+            max(r.get('rss', 0), r.get('rss_children', 0))/1024.0,
+            '%.1f' % (r['bytes']/1e6) if r.get('bytes') is not None else '-')
+
+    print
+    print 'Stages'
+    print '%-16s %6s %10s %10s %10s %10s' % ('stage', 'count', 'total (s)', 'mean (s)', 'max (s)', 'failed')
+    stages = collections.OrderedDict()
+    for r in records:
+        stages.setdefault(r['stage'], []).append(r)
+    for stage, rs in stages.items():
+        wall = [_['wall'] for _ in rs]
+        print '%-16s %6d %10.1f %10.1f %10.1f %10d' % (
+            stage, len(rs), sum(wall), sum(wall)/len(wall), max(wall),
+            sum(1 for _ in rs if _.get('ok') is False))
+
+    # Simulated hours run per hour, and chunks de-chunked, by day
+    print
+    print 'Throughput by day'
+    print '%-10s %8s %14s %10s %14s' % ('day', 'runs', 'sim hr/hr', 'dechunks', 'MB read/s')
+    days = collections.OrderedDict()
+    for r in sorted(records, key=lambda _: _['start']):
+        days.setdefault(r['start'][:10], []).append(r)
+    for day, rs in days.items():
+        runs = [_ for _ in rs if _['stage'] == 'ems_run' and _.get('hours')]
+        reads = [_ for _ in rs if _['stage'] == 'dechunk_read']
+        wall = sum(_['wall'] for _ in runs)
+        rwall = sum(_['wall'] for _ in reads)
+        print '%-10s %8d %14s %10d %14s' % (
+            day, len(runs), '%.1f' % (sum(_['hours'] for _ in runs)/(wall/3600.0)) if wall else '-',
+            len(reads), '%.1f' % (sum(_.get('bytes', 0) for _ in reads)/1e6/rwall) if rwall else '-')
+
+
+def main():
+    """
+    Summarize the metrics recorded by ems_chunk.py and ems_dechunk.py.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('domain', help='specify root domain (or metrics file)')
+
+    parser.add_argument('-n', '--top', metavar='int', default=10, type=int,
+        help='specify number of slowest stages to show')
+
+    args = parser.parse_args()
+
+    fileName = args.domain if os.path.isfile(args.domain) else metrics_file(args.domain)
+    if not os.path.isfile(fileName):
+        print 'ERROR:  No metrics in %s' % fileName
+        raise SystemExit
+
+    with open(fileName) as f:
+        records = [json.loads(_) for _ in f if _.strip()]
+
+    summary(records, top=args.top)
+
+
+if __name__ == "__main__":
+    main()